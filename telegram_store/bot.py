@@ -1,9 +1,11 @@
 # Telegram
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from telegram.error import BadRequest, RetryAfter, Forbidden
 from telegram.ext import (
     Application,
     CommandHandler,
     CallbackQueryHandler,
+    TypeHandler,
     MessageHandler,
     filters,
     CallbackContext,
@@ -16,14 +18,22 @@ import logging
 from logging.handlers import RotatingFileHandler
 from asgiref.sync import sync_to_async
 import asyncio
+import statistics
+import threading
+from contextvars import ContextVar
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
 import aiohttp
+from yarl import URL
 from cachetools import TTLCache, LRUCache
+from array import array
+import hashlib
 
 from bot_settings import *
 
 # Timezone
 import timezonefinder
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone as dt_timezone
 from pytz import timezone as pytz_timezone
 from django.utils import timezone
 
@@ -31,15 +41,22 @@ from django.utils import timezone
 import os
 import django
 from django.db import transaction
-from django.db.models import Exists, OuterRef
+from django.db.backends.signals import connection_created
+from django.db.models import F, Q
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'telegram_store.settings')
 django.setup()
 
-if __name__ == "__main__":
-    from products.models import Category, Product, ProductDetail
-    from payment.models import Transaction, TonCursor
-    from users.models import UserData, BotSettings
+# module level (after setup), so tests can import the handlers
+from products.models import Product, ProductDetail
+from products import catalog
+from products.stock import claim_product_detail, find_stock_drift
+from payment.models import Transaction, TonCursor, TonPriceSnapshot
+from payment import deposits
+from payment.deposits import ton_cursor_key
+from users.models import UserData, BotSettings
+from users import profiles
+from routing import CallbackRouter, route_queries
 
 
 # region Logs
@@ -55,16 +72,146 @@ formatter = logging.Formatter(
 )
 handler.setFormatter(formatter)
 logger.addHandler(handler)
+# app modules (payment.deposits, products.renditions, ...) log to the same file
+for app_logger in ("payment", "products", "users", "routing"):
+    logging.getLogger(app_logger).addHandler(handler)
+# endregion
+
+
+# region Seen Hashes
+
+class TxHashIndex:
+    """
+    Compact set of recently seen transaction hashes.
+
+    Each hash is folded into a 64-bit blake2b digest and stored in an open-addressing
+    table backed by array('Q'), ~16-32 bytes per hash instead of ~250 bytes for a
+    string key in an LRUCache. Two generations are kept: when the active table is
+    full the previous one is dropped, so memory stays fixed.
+    """
+
+    def __init__(self, capacity: int = 100_000):
+        self.generation_size = max(capacity // 2, 1)
+        # keep every table at most half full
+        self._slots = 1 << (self.generation_size * 2 - 1).bit_length()
+        self._mask = self._slots - 1
+        self._active = self._new_table()
+        self._previous = self._new_table()
+        self._count = 0
+
+    def _new_table(self) -> array:
+        return array("Q", bytes(8 * self._slots))
+
+    @staticmethod
+    def _digest(tx_hash: str) -> int:
+        key = int.from_bytes(hashlib.blake2b(tx_hash.encode(), digest_size=8).digest(), "little")
+        return key or 1  # 0 marks an empty slot
+
+    def _slot(self, table: array, key: int) -> int:
+        # linear probing: index of the key, or of the empty slot where it would go
+        i = key & self._mask
+        while table[i] != 0 and table[i] != key:
+            i = (i + 1) & self._mask
+        return i
+
+    def __contains__(self, tx_hash: str) -> bool:
+        key = self._digest(tx_hash)
+        return (self._active[self._slot(self._active, key)] == key
+                or self._previous[self._slot(self._previous, key)] == key)
+
+    def add(self, tx_hash: str) -> None:
+        key = self._digest(tx_hash)
+        i = self._slot(self._active, key)
+        if self._active[i] == key or self._previous[self._slot(self._previous, key)] == key:
+            return
+
+        if self._count >= self.generation_size:
+            self._previous, self._active = self._active, self._new_table()
+            self._count = 0
+            i = self._slot(self._active, key)
+
+        self._active[i] = key
+        self._count += 1
+
+    def __len__(self) -> int:
+        return self._count + sum(1 for key in self._previous if key)
+
+# endregion
+
+
+# region History Pages
+
+class HistoryPageCache(LRUCache):
+    """
+    Rendered history pages: (history callback, user id, language, utc offset, page size, callback data)
+    -> (text, reply markup).
+
+    Bounded by approximate size in bytes, least recently used pages go first. A per-(history, user)
+    key index lets invalidate() drop exactly one user's pages when their history changes.
+    """
+
+    MARKUP_SIZE = 512  # rough size of a pagination InlineKeyboardMarkup
+
+    def __init__(self, max_bytes: int):
+        super().__init__(maxsize=max_bytes, getsizeof=lambda page: len(page[0]) * 2 + self.MARKUP_SIZE)
+        self._keys: dict = {}  # (history callback, user id) -> set of cache keys
+        self.hits = self.misses = self.invalidations = 0
+
+    def lookup(self, key):
+        page = self.get(key)
+        if page is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return page
+
+    def __setitem__(self, key, value, *args, **kwargs):
+        super().__setitem__(key, value, *args, **kwargs)
+        self._keys.setdefault(key[:2], set()).add(key)
+
+    def popitem(self):
+        key, value = super().popitem()  # evicted
+        self._forget(key)
+        return key, value
+
+    def _forget(self, key) -> None:
+        keys = self._keys.get(key[:2])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys[key[:2]]
+
+    def invalidate(self, kind: str, user_id: int) -> None:
+        for key in self._keys.pop((kind, user_id), ()):
+            self.pop(key, None)
+        self.invalidations += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {"pages": len(self), "bytes": self.currsize, "max_bytes": self.maxsize, "hits": self.hits,
+                "misses": self.misses, "hit_rate": self.hits / lookups if lookups else 0.0,
+                "invalidations": self.invalidations}
+
+    def log_stats(self) -> None:
+        stats = self.stats()
+        logger.warning(
+            f"History page cache: {stats['pages']} pages, {stats['bytes']}/{stats['max_bytes']} bytes, "
+            f"{stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.0%}), "
+            f"{stats['invalidations']} invalidations"
+        )
+
 # endregion
 
 
 # region Global Variables
 # TTLCache: maxsize 1 because you only have one settings object, TTL 10 minutes
-ton_price: TTLCache = TTLCache(maxsize=1, ttl=3600)
+TON_PRICE_MAX_AGE = 3600  # last good price is served until it is this old (seconds)
+ton_price: TTLCache = TTLCache(maxsize=1, ttl=TON_PRICE_MAX_AGE)
 settings_cache: TTLCache = TTLCache(maxsize=1, ttl=600)
-language_cache: TTLCache = TTLCache(maxsize=1000, ttl=600)
-timezone_cache: TTLCache = TTLCache(maxsize=1000, ttl=600)
-seen_hashes_cache: LRUCache = LRUCache(maxsize=10000) # keep 10k most recent tx hashes
+history_counts: TTLCache = TTLCache(maxsize=10_000, ttl=3600)  # (history callback, user id) -> total rows
+NAMES_FLUSH_INTERVAL = 30  # seconds between batched writes of changed Telegram names
+history_pages: HistoryPageCache = HistoryPageCache(max_bytes=8 * 1024 * 1024)  # rendered history pages, ~8 MB
+seen_hashes: TxHashIndex = TxHashIndex(capacity=100_000)  # ~100k most recent tx hashes, warmed at startup
 
 lang_keys = list(texts.keys())
 # endregion
@@ -98,6 +245,135 @@ async def update_setting(update: Update, context: CallbackContext) -> None:
 # endregion
 
 
+# region HTTP
+
+# One pooled session per process: keep-alive + DNS cache instead of a new TCP/TLS handshake per request
+http_session: aiohttp.ClientSession | None = None
+
+HTTP_DEFAULT_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=3)
+HTTP_TIMEOUTS = {
+    "toncenter.com": aiohttp.ClientTimeout(total=15, connect=5),
+    "tonapi.io": aiohttp.ClientTimeout(total=5, connect=3),
+    "api.coingecko.com": aiohttp.ClientTimeout(total=5, connect=3),
+    "pro-api.coinmarketcap.com": aiohttp.ClientTimeout(total=5, connect=3),
+}
+
+# host -> summed timings in seconds (connect only counts new connections)
+http_timings: dict = {}
+
+
+def record_http_timing(host: str, **timings) -> None:
+    stats = http_timings.setdefault(host, {"requests": 0, "connections": 0,
+                                           "connect": 0.0, "ttfb": 0.0, "total": 0.0})
+    for name, value in timings.items():
+        stats[name] += value
+
+
+async def _trace_request_start(session, ctx, params):
+    ctx.start = asyncio.get_running_loop().time()
+
+
+async def _trace_connection_create_start(session, ctx, params):
+    ctx.connect_start = asyncio.get_running_loop().time()
+
+
+async def _trace_connection_create_end(session, ctx, params):
+    ctx.connect = asyncio.get_running_loop().time() - ctx.connect_start
+
+
+async def _trace_request_end(session, ctx, params):
+    # Fired once the response headers are in -> time to first byte
+    connect = getattr(ctx, "connect", None)
+    record_http_timing(params.url.host,
+                       requests=1,
+                       connections=int(connect is not None),
+                       connect=connect or 0.0,
+                       ttfb=asyncio.get_running_loop().time() - ctx.start)
+
+
+def create_http_session() -> aiohttp.ClientSession:
+    trace = aiohttp.TraceConfig()
+    trace.on_request_start.append(_trace_request_start)
+    trace.on_connection_create_start.append(_trace_connection_create_start)
+    trace.on_connection_create_end.append(_trace_connection_create_end)
+    trace.on_request_end.append(_trace_request_end)
+
+    connector = aiohttp.TCPConnector(
+        limit=100,
+        limit_per_host=10,
+        ttl_dns_cache=300,
+        keepalive_timeout=60,
+    )
+    return aiohttp.ClientSession(connector=connector, trace_configs=[trace])
+
+
+def get_http_session() -> aiohttp.ClientSession:
+    global http_session
+    if http_session is None or http_session.closed:
+        http_session = create_http_session()
+    return http_session
+
+
+async def http_get_json(url: str, params: dict = None, headers: dict = None):
+    """GET through the shared session, return (status, json or None)."""
+    session = get_http_session()
+    host = URL(url).host
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+
+    async with session.get(url,
+                           params=params,
+                           headers=headers,
+                           timeout=HTTP_TIMEOUTS.get(host, HTTP_DEFAULT_TIMEOUT)) as resp:
+        data = await resp.json(content_type=None) if resp.status == 200 else None
+
+    record_http_timing(host, total=loop.time() - started)
+    return resp.status, data
+
+
+class RateLimiter:
+    """Token bucket: `rate` acquisitions per second, bursts of up to `burst`."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = float(burst)
+        self._updated = None
+
+    async def acquire(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            now = loop.time()
+            if self._updated is not None:
+                self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+def log_http_timings() -> None:
+    for host, stats in http_timings.items():
+        requests = stats["requests"] or 1
+        logger.warning(
+            f"HTTP {host}: {stats['requests']} requests, {stats['connections']} new connections, "
+            f"avg connect {stats['connect'] / max(stats['connections'], 1) * 1000:.0f} ms, "
+            f"avg ttfb {stats['ttfb'] / requests * 1000:.0f} ms, "
+            f"avg total {stats['total'] / requests * 1000:.0f} ms"
+        )
+
+
+async def close_http_session() -> None:
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
+
+# endregion
+
+
 # region Menu Balance
 
 # active command: /start and /menu
@@ -145,12 +421,19 @@ async def user_balance(update: Update, context: CallbackContext, query: Callback
     
     try:
         s: BotSettings = await get_settings()
-        balance = await sync_to_async(
-            lambda: UserData.objects.filter(id=user_id)
-                                    .values_list("balance", flat=True)
-                                    .first(),
-            thread_sensitive=True
-        )()
+        user = current_user_row(user_id)  # read by load_user_profile for this update
+        profile = profiles.cached(user_id)
+        if user is not None:
+            balance = user.balance
+        elif profile is not None and not profile.exists:
+            balance = None
+        else:
+            balance = await sync_to_async(
+                lambda: UserData.objects.filter(id=user_id)
+                                        .values_list("balance", flat=True)
+                                        .first(),
+                thread_sensitive=True
+            )()
 
         if balance is None:
             await check_create_account(update)
@@ -173,15 +456,30 @@ async def user_balance(update: Update, context: CallbackContext, query: Callback
 # region TON
 
 @sync_to_async
-def get_last_lt() -> int:
-    obj, _ = TonCursor.objects.get_or_create(key="deposit_cursor", defaults={"last_lt": 0})
+def get_last_lt(address: str, adopt_legacy: bool = False) -> int:
+    key = ton_cursor_key(address)
+    if adopt_legacy and not TonCursor.objects.filter(key=key).exists():
+        # Cursor written before multi-address support belongs to the primary address
+        TonCursor.objects.filter(key="deposit_cursor").update(key=key)
+
+    obj, _ = TonCursor.objects.get_or_create(key=key, defaults={"last_lt": 0})
     return obj.last_lt
 
 
 @sync_to_async
-def update_last_lt(new_lt):
+def warm_seen_hashes() -> int:
+    """Load the most recent tx hashes into seen_hashes with a single streaming query."""
+    recent = (Transaction.objects.order_by("-id")
+                                 .values_list("tx_id", flat=True)[:seen_hashes.generation_size])
+    for tx_hash in recent.iterator(chunk_size=5000):
+        seen_hashes.add(tx_hash)
+    return len(seen_hashes)
+
+
+@sync_to_async
+def update_last_lt(address: str, new_lt):
     with transaction.atomic():
-        cursor = TonCursor.objects.select_for_update().get(key="deposit_cursor")
+        cursor = TonCursor.objects.select_for_update().get(key=ton_cursor_key(address))
         cursor.last_lt = new_lt
         cursor.save()
 
@@ -204,9 +502,73 @@ def record_failed_tx(tx_hash, amount, comment, price, price_currency, lt=None):
     except:
         return False
 
-# Todo: add retry
+TON_PRICE_HEDGE_DELAY = 0.5  # seconds before the next provider is asked as well
+# provider url -> {"ok", "fail", "latency"}, latency is a moving average in seconds
+price_provider_stats: dict = {}
+price_refresh_task: asyncio.Task | None = None
+
+
+def record_price_provider(url: str, ok: bool, latency: float) -> None:
+    stats = price_provider_stats.setdefault(url, {"ok": 0, "fail": 0, "latency": latency})
+    stats["ok" if ok else "fail"] += 1
+    stats["latency"] = 0.8 * stats["latency"] + 0.2 * latency
+
+
+def price_provider_score(url: str) -> float:
+    """Expected seconds per good answer, lower is better (unknown providers go first)."""
+    stats = price_provider_stats.get(url)
+    if stats is None:
+        return 0
+    success_rate = (stats["ok"] + 1) / (stats["ok"] + stats["fail"] + 2)
+    return stats["latency"] / success_rate
+
+
+async def fetch_price_from(api: dict) -> float | None:
+    loop = asyncio.get_running_loop()
+    started = loop.time()
+    price = None
+    try:
+        status, data = await http_get_json(
+            api["url"],
+            params=api.get("params"),
+            headers=api.get("headers"),
+        )
+
+        if status != 200:
+            logger.warning(f"HTTP {status} from {api['url']}")
+        else:
+            price = api["parse"](data)
+            if price is None:
+                logger.warning(f"Price not found in {api['url']} response")
+
+    except asyncio.CancelledError:
+        # lost the race: count the time spent so slow providers get demoted
+        record_price_provider(api["url"], False, loop.time() - started)
+        raise
+    except Exception as e:
+        logger.warning(f"Failed fetching price from {api['url']}: {e}")
+
+    record_price_provider(api["url"], price is not None, loop.time() - started)
+    return float(price) if price is not None else None
+
+
 async def get_ton_price():
-    global ton_price
+    """Refresh ton_price, sharing one in-flight refresh between concurrent callers."""
+    global price_refresh_task
+    if price_refresh_task is None or price_refresh_task.done():
+        price_refresh_task = asyncio.create_task(refresh_ton_price())
+    return await asyncio.shield(price_refresh_task)
+
+
+async def refresh_ton_price():
+    """
+    Ask the price providers in a hedged race: best scored provider first, the next
+    one every TON_PRICE_HEDGE_DELAY seconds (or right away when one fails).
+    The first valid answer wins, or the median when several arrive together.
+
+    Readers keep getting the last good price from ton_price while this runs,
+    it expires after TON_PRICE_MAX_AGE.
+    """
     s: BotSettings = await get_settings()
     currency = s.wallet_currency.lower()
 
@@ -236,44 +598,102 @@ async def get_ton_price():
             "parse": lambda data: data["data"]["TON"]["quote"][currency.upper()]["price"]
         }
     ]
+    apis.sort(key=lambda api: price_provider_score(api["url"]))
 
-    for api in apis:
-        try:
-            async with aiohttp.ClientSession() as session:
-                resp = await session.get(
-                    api["url"],
-                    params=api.get("params"),
-                    headers=api.get("headers"),
-                    timeout=5
-                )
-                
-                if resp.status != 200:
-                    logger.warning(f"HTTP {resp.status} from {api['url']}")
-                    continue
-
-                data = await resp.json()
-                
-                price = api["parse"](data)
-                if price is not None:
-                    ton_price.update(price=round(float(price), 3))
-                    return ton_price
-
-                logger.warning(f"Price not found in {api['url']} response")
-
-        except Exception as e:
-            logger.warning(f"Failed fetching price from {api['url']}: {e}")
-
-    logger.error("All TON price APIs failed")
-    return None
+    answers = []
+    pending = set()
+    try:
+        for api in apis:
+            pending.add(asyncio.create_task(fetch_price_from(api)))
+            done, pending = await asyncio.wait(pending, timeout=TON_PRICE_HEDGE_DELAY,
+                                               return_when=asyncio.FIRST_COMPLETED)
+            answers += [t.result() for t in done if t.result() is not None]
+            if answers:
+                break
+
+        while not answers and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            answers += [t.result() for t in done if t.result() is not None]
+    finally:
+        for task in pending:
+            task.cancel()
+
+    if not answers:
+        logger.error("All TON price APIs failed")
+        return None
+
+    ton_price.update(price=round(statistics.median(answers), 3))
+    record_price_sample(ton_price["price"], currency)
+    return ton_price
 
 
 async def ton_price_job():
     s: BotSettings = await get_settings()
     while True:
         await get_ton_price()
+        if len(price_snapshot_buffer) >= PRICE_SNAPSHOT_FLUSH_EVERY:
+            try:
+                await flush_price_snapshots()
+            except Exception as e:
+                logger.error(f"Failed to flush TON price snapshots: {e}")
         await asyncio.sleep(s.ton_price_delay)
 
 
+# Price history
+PRICE_SNAPSHOT_FLUSH_EVERY = 10  # samples buffered before one bulk insert
+# recent (time, currency, price) samples, oldest first
+price_history: deque = deque(maxlen=4096)
+price_snapshot_buffer: list = []
+
+
+def record_price_sample(price: float, currency: str) -> None:
+    sample = (timezone.now(), currency.lower(), price)
+    price_history.append(sample)
+    price_snapshot_buffer.append(sample)
+
+
+@sync_to_async
+def flush_price_snapshots() -> None:
+    samples = list(price_snapshot_buffer)
+    if not samples:
+        return
+    TonPriceSnapshot.objects.bulk_create([
+        TonPriceSnapshot(created_at=created_at, currency=currency, price=Decimal(str(price)))
+        for created_at, currency, price in samples
+    ])
+    del price_snapshot_buffer[:len(samples)]
+
+
+@sync_to_async
+def load_price_history() -> None:
+    """Warm the ring buffer from the latest snapshots with one query."""
+    snapshots = (TonPriceSnapshot.objects.order_by("-created_at")
+                                         .values_list("created_at", "currency", "price")[:price_history.maxlen])
+    for created_at, currency, price in reversed(list(snapshots)):
+        price_history.append((created_at, currency, float(price)))
+
+
+async def price_at(when, currency: str) -> float | None:
+    """TON price at time `when`: the latest sample not after it (ring buffer first, then DB)."""
+    currency = currency.lower()
+    # on the event loop, record_price_sample() can't append while the buffer is walked
+    if price_history and price_history[0][0] <= when:
+        for created_at, sample_currency, price in reversed(price_history):
+            if created_at <= when and sample_currency == currency:
+                return price
+
+    return await stored_price_at(when, currency)
+
+
+@sync_to_async
+def stored_price_at(when, currency: str) -> float | None:
+    price = (TonPriceSnapshot.objects.filter(currency=currency, created_at__lte=when)
+                                     .order_by("-created_at")
+                                     .values_list("price", flat=True)
+                                     .first())
+    return float(price) if price is not None else None
+
+
 """ 
 Todo 
 * Handle High traffic / large number of transactions
@@ -310,65 +730,154 @@ def apply_transaction(user_id, ton_amount, tx_hash, balance_update: Decimal, wal
 
 
 # https://toncenter.com/api/
-async def ton_polling(app):
-    ton_api_url = "https://toncenter.com/api/v2/getTransactions"
-    s: BotSettings = await get_settings()
+TON_API_URL = "https://toncenter.com/api/v2/getTransactions"
+# requests per second, updated from BotSettings.ton_api_rate_limit
+ton_api_limiter: RateLimiter = RateLimiter(rate=1)
+
+
+async def fetch_ton_page(params: dict, retry: int = 3) -> list:
+    """Fetch one getTransactions page (newest first), waiting out 429 and 5xx responses."""
+    for attempt in range(retry):
+        await ton_api_limiter.acquire()
+        status, data = await http_get_json(TON_API_URL, params=params)
+        if status == 429 or status >= 500:
+            await asyncio.sleep(2 ** attempt)
+            continue
+        if data is None:
+            raise RuntimeError(f"HTTP {status} from toncenter")
+
+        if not data.get("ok", True):
+            raise RuntimeError(f"toncenter error: {data.get('error')}")
+        return data.get("result", [])
+
+    raise RuntimeError(f"toncenter unavailable (HTTP {status})")
 
+
+# address -> (last_lt, anchors) of a backwards walk interrupted by a failed fetch
+ton_walks: dict = {}
+
+
+def ton_page_params(s: BotSettings, address: str, anchor: tuple | None) -> dict:
     params = {
-        "address": s.ton_deposit_address,
+        "address": address,
         "limit": s.ton_fetch_limit,
         "api_key": s.ton_network_api_key,
     }
+    if anchor is not None:
+        params["lt"], params["hash"] = anchor
+    return params
 
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(ton_api_url, params=params) as resp:
-                data = await resp.json()
-    except Exception as e:
-        logger.error(f"Failed to fetch TON transactions: {e}")
-        return
 
-    price = ton_price.get("price")
-    if price is None:
-        await get_ton_price()
-        logger.warning("TON price not available, skipping transaction processing")
-        return
+def tx_lt_of(tx: dict) -> int | None:
+    tx_lt = tx.get("transaction_id", {}).get("lt")
+    return int(tx_lt) if tx_lt is not None else None
 
-    last_transaction_lt = await get_last_lt()
-    
-    # Extract & filter NEW transactions
-    txs = data.get("result", [])
-    new_txs = []
-    for tx in txs:
-        tx_id = tx.get("transaction_id", {})
-        tx_lt = tx_id.get("lt")
-        if tx_lt is None:
+
+async def find_ton_anchors(s: BotSettings, address: str, last_lt: int) -> tuple[list, list]:
+    """
+    Walk the deposit address history backwards (newest → oldest) until the TonCursor
+    boundary (last_lt) and return the continuation anchor of every page, newest first:
+    None for the first page, then the (lt, hash) of the oldest transaction of the page
+    before. Only the anchors are kept, plus the raw last page, which is returned too.
+
+    A walk interrupted by a failed fetch is resumed from its last anchor by the next poll.
+    """
+    limit = s.ton_fetch_limit
+    walk_lt, anchors = ton_walks.pop(address, (None, None))
+    if walk_lt != last_lt:
+        anchors = [None]
+
+    while True:
+        try:
+            txs = await fetch_ton_page(ton_page_params(s, address, anchors[-1]))
+        except Exception:
+            if len(anchors) > 1:
+                ton_walks[address] = (last_lt, anchors)
+            raise
+
+        reached_cursor = any(tx_lt is not None and tx_lt <= last_lt for tx_lt in map(tx_lt_of, txs))
+        if reached_cursor or len(txs) < limit:
+            return anchors, txs
+
+        oldest = txs[-1].get("transaction_id", {})
+        anchor = (oldest.get("lt"), oldest.get("hash"))
+        if anchor == anchors[-1]:
+            return anchors, txs  # no progress, avoid looping on the same page
+        anchors.append(anchor)
+
+
+def slim_ton_page(txs: list, last_lt: int) -> list:
+    """Transactions of a raw page newer than last_lt as slim records, oldest first."""
+    page = []
+    for tx in reversed(txs):
+        tx_lt = tx_lt_of(tx)
+        if tx_lt is None or tx_lt <= last_lt:
             continue
-        if int(tx_lt) > last_transaction_lt:
-            new_txs.append(tx)
+        msg = tx.get("in_msg") or {}
+        page.append({
+            "lt": tx_lt,
+            "hash": tx.get("transaction_id", {}).get("hash"),
+            "comment": (msg.get("message") or "").strip(),
+            "value": int(msg.get("value") or 0),
+        })
+    return page
+
+
+async def iter_new_ton_pages(s: BotSettings, address: str, last_lt: int):
+    """
+    Yield every transaction newer than last_lt, one page at a time, oldest page first
+    and oldest transaction first within a page.
+
+    The pages are found by find_ton_anchors() and fetched again oldest first, so memory
+    stays at one page whatever the backlog. The caller applies a page (advancing the
+    cursor to its newest lt) before asking for the next one; stopping the iteration
+    keeps what was applied, the next poll continues from the cursor.
+    """
+    anchors, txs = await find_ton_anchors(s, address, last_lt)
+    if len(anchors) > 1:
+        logger.warning(f"TON catch-up {address}: {len(anchors)} pages")
+
+    for i, anchor in enumerate(reversed(anchors)):
+        if i:
+            # anchored pages start with their anchor (the oldest transaction of the newer
+            # page), which overlaps the page just applied and keeps them contiguous
+            txs = await fetch_ton_page(ton_page_params(s, address, anchor))
+            reaches_cursor = any(tx_lt is not None and tx_lt <= last_lt for tx_lt in map(tx_lt_of, txs))
+            if not reaches_cursor and len(txs) >= s.ton_fetch_limit:
+                # more new transactions than a page arrived on top since the walk, a gap
+                # would follow; the next poll walks again from the cursor
+                return
 
-    if not new_txs:
-        return
+        page = slim_ton_page(txs, last_lt)
+        if page:
+            yield page
+            last_lt = page[-1]["lt"]
+
+
+@sync_to_async
+def apply_deposit_batch(address: str, txs: list, price, wallet_currency: str) -> list:
+    return deposits.apply_deposit_batch(address, txs, price, wallet_currency, seen=seen_hashes)
 
-    # Sort by lt ASC → oldest first
-    new_txs.sort(key=lambda t: t["transaction_id"]["lt"])
 
+async def apply_transactions_one_by_one(app, address: str, txs: list, price) -> bool:
+    """
+    Slow path used when a batch rolls back: apply (or record as failed) each
+    transaction on its own. Returns False if it had to stop early.
+    """
+    last_transaction_lt = await get_last_lt(address)
     max_success_lt = last_transaction_lt
+    completed = True
 
-    # Process each transaction
-    for tx in new_txs:
-        tx_id = tx.get("transaction_id", {})
-        tx_hash = tx_id.get("hash")
-        tx_lt = tx_id.get("lt")
+    for tx in txs:
+        tx_hash = tx["hash"]
+        tx_lt = tx["lt"]
 
         try:
-            if not tx_hash or tx_hash in seen_hashes_cache:
+            if not tx_hash or tx_hash in seen_hashes:
                 continue
-            seen_hashes_cache[tx_hash] = True
 
-            msg = tx.get("in_msg", {})
-            comment_hex = msg.get("message", "").strip()
-            value = int(msg.get("value", 0))
+            comment_hex = tx["comment"]
+            value = tx["value"]
 
             if not comment_hex:
                 continue
@@ -387,6 +896,7 @@ async def ton_polling(app):
                 thread_sensitive=True,
             )()
             if exists:
+                seen_hashes.add(tx_hash)
                 continue
 
             # Check user exists
@@ -394,16 +904,23 @@ async def ton_polling(app):
                 lambda: UserData.objects.filter(id=user_id).exists(),
                 thread_sensitive=True,
             )()
-            if not user_exist:
-                logger.warning(f"User not found for id {user_id}")
-                continue
-
             # Calculate TON deposit
             ton_amount = value / 1e9
             balance_update = Decimal(ton_amount) * Decimal(price)
+            s: BotSettings = await get_settings()
+
+            if not user_exist:
+                # keep the deposit for the retry job, the account is created again on the next update
+                logger.warning(f"User not found for id {user_id}, deposit {tx_hash} recorded as failed")
+                profiles.forget(user_id)
+                if not await record_failed_tx(tx_hash=tx_hash, amount=ton_amount, comment=comment_hex,
+                                              price=price, price_currency=s.wallet_currency, lt=tx_lt):
+                    raise RuntimeError(f"Failed to record deposit {tx_hash} of unknown user {user_id}")
+                seen_hashes.add(tx_hash)
+                max_success_lt = int(tx_lt)
+                continue
 
             # Apply transaction atomically
-            s: BotSettings = await get_settings()
             success = await apply_transaction(
                 user_id, ton_amount, tx_hash, balance_update, s.wallet_currency, comment_hex, tx_lt
             )
@@ -417,93 +934,211 @@ async def ton_polling(app):
                                              price_currency=s.wallet_currency,
                                              lt=tx_lt,
                                             )
-                if not res and tx_hash in seen_hashes_cache:
-                    del seen_hashes_cache[tx_hash] 
-                else:   
+                if res:
                     # Mark LT as successfully processed
+                    seen_hashes.add(tx_hash)
                     max_success_lt = int(tx_lt)
                 continue
 
             # Mark LT as successfully processed
+            seen_hashes.add(tx_hash)
             max_success_lt = int(tx_lt)
 
-            # Notify user
-            try:
-                usr_lng = await user_language(user_id)
-                text = texts[usr_lng]["textChargeAccount"].format(
-                    ton_amount, price, s.wallet_currency
-                )
-                await send_message_with_retry(
-                    bot=app.bot, chat_id=user_id, text=text,
-                    retry=2, parse_mode="Markdown"
-                )
-            except Exception as e:
-                logger.warning(f"Failed to notify user {user_id}: {e}")
+            notifier.enqueue(user_id, "textChargeAccount", ton_amount, price, s.wallet_currency)
+            history_changed(transactions_cb, user_id)
 
         except Exception as e:
-            if tx_hash and tx_hash in seen_hashes_cache:
-                del seen_hashes_cache[tx_hash]
             logger.error(f"Error processing transaction {tx}: {e}")
+            completed = False
             break  # STOP. Do not skip ahead.
 
     # Update last_transaction_lt ONLY AFTER all successful operations
     if max_success_lt > last_transaction_lt:
-        await update_last_lt(max_success_lt)
+        await update_last_lt(address, max_success_lt)
+
+    return completed
 
 
-async def ton_polling_job(app):
+async def ton_polling(app, address: str) -> int:
+    """
+    Fetch and apply new deposits to `address`, return how many new transactions were applied.
+    A page that could not be applied doesn't count, so a failing backlog backs off instead of
+    being walked again right away.
+    """
     s: BotSettings = await get_settings()
+
+    price = ton_price.get("price")
+    if price is None:
+        await get_ton_price()
+        logger.warning("TON price not available, skipping transaction processing")
+        return 0
+
+    last_transaction_lt = await get_last_lt(address)
+
+    applied = 0
+    try:
+        # Apply page by page, oldest first, the cursor advances with every page
+        async for page in iter_new_ton_pages(s, address, last_transaction_lt):
+            try:
+                credited = await apply_deposit_batch(address, page, price, s.wallet_currency)
+            except Exception as e:
+                logger.error(f"Atomic rolled back in apply_deposit_batch(), retrying one by one: {e}")
+                if not await apply_transactions_one_by_one(app, address, page, price):
+                    break  # STOP. Do not skip ahead.
+                applied += len(page)
+                continue
+
+            applied += len(page)
+
+            for tx in page:
+                if tx["hash"]:
+                    seen_hashes.add(tx["hash"])
+
+            for user_id, ton_amount in credited:
+                notifier.enqueue(user_id, "textChargeAccount", ton_amount, price, s.wallet_currency)
+                history_changed(transactions_cb, user_id)
+    except Exception as e:
+        logger.error(f"Failed to fetch TON transactions: {e}")
+
+    return applied
+
+
+# Poll at the floor delay for a while after a /pay link is generated
+TON_PAY_BOOST_SECONDS = 180
+ton_poll_boost_until: float = 0.0
+ton_poll_wakeup: asyncio.Event = asyncio.Event()
+
+
+def boost_ton_polling() -> None:
+    global ton_poll_boost_until
+    ton_poll_boost_until = asyncio.get_running_loop().time() + TON_PAY_BOOST_SECONDS
+    ton_poll_wakeup.set()
+
+
+def next_poll_delay(previous: float | None, found: int, s: BotSettings) -> float:
+    """
+    Adaptive polling interval: poll again right away while pages come back full,
+    use the floor while deposits arrive, back off exponentially up to the ceiling
+    while idle (but never above the floor during a /pay boost).
+    """
+    floor = s.ton_network_min_delay
+    ceiling = max(s.ton_network_delay, floor)
+
+    if found >= s.ton_fetch_limit:
+        return 0
+    if found or previous is None:
+        return floor
+
+    delay = min(max(previous * 2, floor), ceiling)
+    if asyncio.get_running_loop().time() < ton_poll_boost_until:
+        delay = floor
+    return delay
+
+
+async def ton_polling_job(app, address: str, primary: bool = False):
+    """Polling loop for one deposit address, every address has its own cursor and pace."""
+    try:
+        await get_last_lt(address, adopt_legacy=primary)
+    except Exception as e:
+        logger.error(f"Failed to prepare TON cursor for {address}: {e}")
+
+    delay = None
+    warned_addresses = None
     while True:
-        await ton_polling(app)
-        await asyncio.sleep(s.ton_network_delay)
+        s: BotSettings = await get_settings()
+        ton_api_limiter.rate = ton_api_limiter.burst = max(s.ton_api_rate_limit, 1)
+        if primary and s.deposit_addresses() not in (polled_addresses, warned_addresses):
+            warned_addresses = s.deposit_addresses()
+            logger.warning("TON deposit addresses changed in settings, restart the bot to poll the new list")
+
+        found = await ton_polling(app, address)
+        delay = next_poll_delay(delay, found, s)
+
+        # sleep, but wake up early if a pay link was just generated
+        ton_poll_wakeup.clear()
+        try:
+            await asyncio.wait_for(ton_poll_wakeup.wait(), delay)
+            delay = None
+        except asyncio.TimeoutError:
+            pass
 
 
 # Failed Transactions
+FAILED_TX_BATCH_SIZE = 100
+FAILED_TX_MAX_ATTEMPTS = 8
+FAILED_TX_BASE_DELAY = 60  # seconds, doubled after every attempt
+FAILED_TX_MAX_DELAY = 6 * 3600
+
+
 @sync_to_async
-def fetch_failed_transactions():
-    """Fetch unresolved failed TON transactions."""
-    return list(Transaction.objects.filter(atomic_failed=True, is_delete=False))
+def fetch_failed_transactions(limit: int = FAILED_TX_BATCH_SIZE):
+    """Fetch a bounded batch of failed TON transactions that are due for retry."""
+    return list(
+        Transaction.objects.filter(
+            Q(next_retry_at__isnull=True) | Q(next_retry_at__lte=timezone.now()),
+            atomic_failed=True,
+            dead_letter=False,
+            is_delete=False,
+        ).order_by(F("next_retry_at").asc(nulls_first=True))[:limit]
+    )
+
+
+@sync_to_async
+def schedule_failed_retry(tx: Transaction, error: str, permanent: bool = False) -> None:
+    """Record a failed attempt: exponential backoff, dead-letter after too many attempts."""
+    attempts = tx.retry_count + 1
+    delay = min(FAILED_TX_BASE_DELAY * 2 ** (attempts - 1), FAILED_TX_MAX_DELAY)
+    Transaction.objects.filter(pk=tx.pk, atomic_failed=True).update(
+        retry_count=attempts,
+        next_retry_at=timezone.now() + timedelta(seconds=delay),
+        last_error=error[:256],
+        dead_letter=permanent or attempts >= FAILED_TX_MAX_ATTEMPTS,
+    )
 
 
 @sync_to_async
 def apply_failed_transaction(user_id, tx_hash, balance_update: Decimal) -> bool:
-    try:
-        with transaction.atomic():
-            price = ton_price.get("price")
-            if price is None:
-                return False
-            
-            user = UserData.objects.select_for_update().get(id=user_id)
+    """Credit a failed transaction. Raises on error so the caller can schedule a retry."""
+    with transaction.atomic():
+        user = UserData.objects.select_for_update().get(id=user_id)
 
-            user.balance += balance_update
-            user.save()
-                            
-            Transaction.objects.filter(tx_id=tx_hash).update(
-                user=user,
-                atomic_failed=False
-            )
+        resolved = Transaction.objects.filter(tx_id=tx_hash, atomic_failed=True).update(
+            user=user,
+            atomic_failed=False,
+            next_retry_at=None,
+            last_error=None
+        )
+        if not resolved:
+            return False  # already resolved, never credit twice
 
-        return True
-    except Exception as e:
-        logger.error(f"Atomic rolled back in apply_transaction(): {e}")
-        return False
+        user.balance += balance_update
+        user.save()
 
+    return True
 
-async def ton_failed_transactions(app):
-    """Retry unresolved failed transactions."""
-    failed_txs = await fetch_failed_transactions()
-    if not failed_txs:
-        return
 
-    # s: BotSettings = await get_settings()
-    price = ton_price.get("price")
-    if price is None:
-        logger.warning("TON price not available, skipping failed transaction processing")
-        return  # Skip if TON price unavailable
+async def ton_failed_transactions(app) -> int:
+    """
+    Retry due failed transactions, return the size of the fetched batch.
+    Deposits are credited at the rate of when they arrived, no live price needed.
+    """
+    failed_txs = await fetch_failed_transactions()
 
     for tx in failed_txs:
+        price = tx.price_per_ton
+        if price is None:
+            price = await price_at(tx.paid_time, tx.price_currency or "")
+        if price is None:
+            await schedule_failed_retry(tx, "No TON price recorded for this transaction time")
+            continue
+
         try:
             user_id = int(tx.comment, 16)
+        except (TypeError, ValueError):
+            await schedule_failed_retry(tx, f"Invalid comment (not hex): {tx.comment}", permanent=True)
+            continue
+
+        try:
             # Attempt to apply the transaction atomically
             success = await apply_failed_transaction(
                 user_id=user_id,
@@ -511,29 +1146,36 @@ async def ton_failed_transactions(app):
                 balance_update=Decimal(tx.amount) * Decimal(price),
             )
             if success:
-                # Notify user
-                try:
-                    usr_lng = await user_language(user_id)
-                    text = texts[usr_lng]["textChargeAccount"].format(
-                        tx.amount, price, tx.price_currency
-                    )
-                    await send_message_with_retry(
-                        bot=app.bot, chat_id=user_id,
-                        text=text, retry=2, parse_mode="Markdown"
-                    )
-                except Exception as e:
-                    logger.warning(f"Failed to notify user {tx.comment}: {e}")
+                notifier.enqueue(user_id, "textChargeAccount", tx.amount, price, tx.price_currency)
+                history_changed(transactions_cb, user_id)
 
+        except UserData.DoesNotExist:
+            # the account may have been deleted in the admin, it's created again on the user's next update
+            profiles.forget(user_id)
+            await schedule_failed_retry(tx, f"User not found for id {user_id}")
         except Exception as e:
             logger.error(f"Failed to process failed transaction {tx.tx_id}: {e}")
+            try:
+                await schedule_failed_retry(tx, str(e))
+            except Exception as err:
+                logger.error(f"Failed to schedule retry for {tx.tx_id}: {err}")
+
+    return len(failed_txs)
 
 
 async def failed_transactions_job(app):
     """Background loop to retry failed transactions periodically."""
-    s: BotSettings = await get_settings()
     while True:
-        await ton_failed_transactions(app)
-        await asyncio.sleep(s.failed_transactions_delay)
+        s: BotSettings = await get_settings()
+        try:
+            fetched = await ton_failed_transactions(app)
+        except Exception as e:
+            logger.error(f"Error in failed_transactions_job: {e}")
+            fetched = 0
+
+        # a full batch means more rows are due, continue right away
+        if fetched < FAILED_TX_BATCH_SIZE:
+            await asyncio.sleep(s.failed_transactions_delay)
 
 # endregion
 
@@ -560,12 +1202,15 @@ async def pay_link(update: Update, context: ContextTypes.DEFAULT_TYPE, query: Ca
         return
     
     await check_create_account(update)
+    boost_ton_polling()
     
-    link = await generate_ton_link(user_id, s.ton_deposit_address)
+    # only hand out addresses that are polled, the list is fixed at startup
+    deposit_address = s.deposit_address_for(user_id, polled_addresses)
+    link = await generate_ton_link(user_id, deposit_address)
 
     text = (
         texts[usr_lng]["textPaymentLink"].format(
-            s.ton_deposit_address, hex(user_id).lower(), price, s.wallet_currency_sign)
+            deposit_address, hex(user_id).lower(), price, s.wallet_currency_sign)
     )
 
     pay_key = [
@@ -610,13 +1255,15 @@ async def account_menu_call_back(query: CallbackQuery):
                            reply_markup=buttons[usr_lng]["back_menu_markup"])
 
 
-async def account_info(query: CallbackQuery) -> None:
+async def account_info(query: CallbackQuery, context: CallbackContext) -> None:
     user_id = query.from_user.id
     usr_lng = await user_language(user_id)
     s: BotSettings = await get_settings()
 
     try:
-        user_data = await sync_to_async(UserData.objects.filter(id=user_id).first, thread_sensitive=True)()
+        # row read by load_user_profile for this update, or one query on a profile cache hit
+        user_data = current_user_row(user_id) or await sync_to_async(
+            UserData.objects.filter(id=user_id).first, thread_sensitive=True)()
         if user_data is None:
             await send_message(query=query,
                             txt=texts[usr_lng]["textNotUser"],
@@ -636,12 +1283,101 @@ async def account_info(query: CallbackQuery) -> None:
         logger.error(f"Error in account_info function: {e}")
 
 
+CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def to_base36(n: int) -> str:
+    digits = ""
+    while True:
+        n, r = divmod(n, 36)
+        digits = "0123456789abcdefghijklmnopqrstuvwxyz"[r] + digits
+        if not n:
+            return digits
+
+
+def encode_page_cursor(page: int, direction: str, when: datetime, pk: int) -> str:
+    """
+    Compact keyset cursor for callback_data (64 bytes max): "<page>_<n|p><microseconds>.<id>" in base 36.
+    n = rows after (older than) the row, p = rows before (newer than) it.
+    """
+    micros = (when - CURSOR_EPOCH) // timedelta(microseconds=1)
+    return f"{page}_{direction}{to_base36(micros)}.{to_base36(pk)}"
+
+
+def decode_page_cursor(data: str):
+    """callback_data -> (page, direction, when, pk); (1, None, None, None) for the first page."""
+    try:
+        _, page, cursor = data.split('_', 2)
+        direction, micros, pk = cursor[0], *cursor[1:].split('.')
+        if direction not in ("n", "p") or int(page) < 1:
+            raise ValueError(cursor)
+        when = CURSOR_EPOCH + timedelta(microseconds=int(micros, 36))
+        return int(page), direction, when, int(pk, 36)
+    except (IndexError, ValueError, OverflowError):  # first page, an old offset based button or garbage
+        return 1, None, None, None
+
+
+def keyset_page(qs, time_field: str, direction: str | None, when, pk, limit: int):
+    """
+    One page of qs, newest first on (time_field, id), starting after/before the cursor row.
+    Returns (rows, has_older, has_newer).
+    """
+    if direction == "p":
+        rows = list(qs.filter(Q(**{f"{time_field}__gt": when}) | Q(**{time_field: when, "id__gt": pk}))
+                      .order_by(time_field, "id")[:limit + 1])
+        has_newer = len(rows) > limit
+        return rows[:limit][::-1], True, has_newer
+
+    if direction == "n":
+        qs = qs.filter(Q(**{f"{time_field}__lt": when}) | Q(**{time_field: when, "id__lt": pk}))
+    rows = list(qs.order_by(f"-{time_field}", "-id")[:limit + 1])
+    return rows[:limit], len(rows) > limit, direction == "n"
+
+
+def history_changed(kind: str, user_id: int, n: int = 1) -> None:
+    """
+    A new row in a user's history: keep a cached total in step (uncached totals are counted on demand)
+    and drop the user's rendered pages of that history.
+    """
+    key = (kind, user_id)
+    if key in history_counts:
+        history_counts[key] += n
+    history_pages.invalidate(kind, user_id)
+
+
+async def history_count(kind: str, user_id: int, qs) -> int:
+    key = (kind, user_id)
+    total = history_counts.get(key)
+    if total is None:
+        total = history_counts[key] = await sync_to_async(qs.count, thread_sensitive=True)()
+    return total
+
+
+def history_page_buttons(cb: str, page: int, rows: list, time_field: str, has_older: bool, has_newer: bool,
+                         usr_lng: str) -> list:
+    keys = []
+    if has_newer:
+        first = rows[0]
+        keys.append(InlineKeyboardButton(
+            texts[usr_lng]["textPrev"],
+            callback_data=f"{cb}_{encode_page_cursor(max(page - 1, 1), 'p', getattr(first, time_field), first.id)}"
+        ))
+    if has_older:
+        last = rows[-1]
+        keys.append(InlineKeyboardButton(
+            texts[usr_lng]["textNext"],
+            callback_data=f"{cb}_{encode_page_cursor(page + 1, 'n', getattr(last, time_field), last.id)}"
+        ))
+    return keys
+
+
+def user_transactions_qs(user_id):
+    return Transaction.objects.filter(user_id=user_id, is_delete=False, atomic_failed=False)
+
+
 @sync_to_async
-def get_transactions(user_id, start, limit):
-    qs = Transaction.objects.filter(user_id=user_id, is_delete=False, atomic_failed=False)
-    total = qs.count()
-    transactions = list(qs.order_by('-paid_time')[start:start+limit])
-    return transactions, total
+def get_transactions(user_id, direction, when, pk, limit):
+    return keyset_page(user_transactions_qs(user_id), "paid_time", direction, when, pk, limit)
 
 # Todo: Move it to website
 async def account_transactions(query: CallbackQuery) -> None:
@@ -659,36 +1395,33 @@ async def account_transactions(query: CallbackQuery) -> None:
 
     formatted_utc_offset = format_utc_offset(usr_utc_offset)
 
-    try:
-        temp: list = query.data.split('_')
-        if len(temp) == 1:
-            start_index = 0
-        else:
-            # Extract start index from callback data
-            start_index: int = int(query.data.split('_')[1])
-            if start_index < 0:
-                return
-
-    except (IndexError, ValueError):
-        await query.answer(texts[usr_lng]["textNotFound"], show_alert=True)
-        return
+    # Page number and keyset cursor from callback data
+    current_page, direction, when, pk = decode_page_cursor(query.data)
 
     try:
         s: BotSettings = await get_settings()
+        # Same page rendered before, nothing changed for this user since
+        page_key = (transactions_cb, user_id, usr_lng, usr_utc_offset, s.number_of_transactions, query.data)
+        cached_page = history_pages.lookup(page_key)
+        if cached_page:
+            await send_message(query=query, txt=cached_page[0], reply_markup=cached_page[1], parse_mode="Markdown")
+            return
+
         # Fetch transactions and total count
-        user_transactions, total_transactions = await get_transactions(user_id, start_index, s.number_of_transactions)
+        user_transactions, has_older, has_newer = await get_transactions(
+            user_id, direction, when, pk, s.number_of_transactions)
+        total_transactions = await history_count(transactions_cb, user_id, user_transactions_qs(user_id))
 
-        if user_transactions is None:
-            if start_index == 0:
+        if not user_transactions:
+            if direction is None:
                 await send_message(query=query,
                                    txt=texts[usr_lng]["textNoTransaction"],
                                    reply_markup=buttons[usr_lng]["back_to_acc_markup"])
             return
 
         # Calculate page info
-        current_page = start_index // s.number_of_transactions + 1
-        total_pages = (total_transactions +
-                       s.number_of_transactions - 1) // s.number_of_transactions
+        total_pages = max((total_transactions +
+                           s.number_of_transactions - 1) // s.number_of_transactions, current_page)
 
         # Page number
         result_data = texts[usr_lng]["textTransaction"].format(
@@ -711,25 +1444,8 @@ async def account_transactions(query: CallbackQuery) -> None:
                                                                           formatted_utc_offset) + SEP_LINE
 
         # Pagination buttons
-        transactions_keys = []
-
-        # Add "Previous" button only if there is a previous page
-        if start_index > 0:
-            transactions_keys.append(
-                InlineKeyboardButton(
-                    texts[usr_lng]["textPrev"],
-                    callback_data=f"{transactions_cb}_{start_index - s.number_of_transactions}"
-                )
-            )
-
-        # Add "Next" button only if there is a next page
-        if start_index + s.number_of_transactions < total_transactions:
-            transactions_keys.append(
-                InlineKeyboardButton(
-                    texts[usr_lng]["textNext"],
-                    callback_data=f"{transactions_cb}_{start_index + s.number_of_transactions}"
-                )
-            )
+        transactions_keys = history_page_buttons(transactions_cb, current_page, user_transactions, "paid_time",
+                                                 has_older, has_newer, usr_lng)
 
         # Add buttons for account and main menu navigation
         navigation_buttons = [
@@ -746,6 +1462,7 @@ async def account_transactions(query: CallbackQuery) -> None:
         else:
             transactions_markup = InlineKeyboardMarkup(navigation_buttons)
 
+        history_pages[page_key] = (result_data, transactions_markup)
         await send_message(query=query,
                     txt=result_data,
                     reply_markup=transactions_markup,
@@ -755,17 +1472,18 @@ async def account_transactions(query: CallbackQuery) -> None:
         logger.error(f"Error in account_transactions function: {e}")
 
 
-@sync_to_async
-def get_user_purchases(user_id, start_index, limit):
-    qs = ProductDetail.objects.filter(
+def user_purchases_qs(user_id):
+    return ProductDetail.objects.filter(
         is_purchased=True,
         buyer__id=user_id,
         is_delete=False
-    ).select_related('product').order_by('-purchase_date')
+    )
+
 
-    total = qs.count()  # total number of purchases
-    purchases = list(qs[start_index:start_index + limit])  # paginated slice
-    return purchases, total
+@sync_to_async
+def get_user_purchases(user_id, direction, when, pk, limit):
+    qs = user_purchases_qs(user_id).select_related('product')
+    return keyset_page(qs, "purchase_date", direction, when, pk, limit)
 
 # Todo: Move it to website
 async def user_purchase_products(query: CallbackQuery) -> None:
@@ -782,39 +1500,35 @@ async def user_purchase_products(query: CallbackQuery) -> None:
     usr_utc_offset = await user_timezone(user_id)
 
     formatted_utc_offset = format_utc_offset(usr_utc_offset)
-    
-    try:
-        temp: list = query.data.split('_')
-        if len(temp) == 1:
-            start_index = 0
-        else:
-            # Extract start index from callback data
-            start_index: int = int(query.data.split('_')[1])
-            if start_index < 0:
-                return
 
-    except (IndexError, ValueError):
-        await query.answer(texts[usr_lng]["textNotFound"], show_alert=True)
-        return
+    # Page number and keyset cursor from callback data
+    current_page, direction, when, pk = decode_page_cursor(query.data)
 
     try:
         s: BotSettings = await get_settings()
+        # Same page rendered before, nothing changed for this user since
+        page_key = (purchase_products_cb, user_id, usr_lng, usr_utc_offset, s.number_of_product, query.data)
+        cached_page = history_pages.lookup(page_key)
+        if cached_page:
+            await send_message(query=query, txt=cached_page[0], reply_markup=cached_page[1], parse_mode="Markdown")
+            return
+
         # Fetch products and total count
-        user_products, total_purchase = await get_user_purchases(
-            user_id, start_index, s.number_of_product
+        user_products, has_older, has_newer = await get_user_purchases(
+            user_id, direction, when, pk, s.number_of_product
         )
+        total_purchase = await history_count(purchase_products_cb, user_id, user_purchases_qs(user_id))
 
         if not user_products:
-            if start_index == 0:
+            if direction is None:
                 await send_message(query=query,
                     txt=texts[usr_lng]["textNotFound"],
                     reply_markup=buttons[usr_lng]["back_to_acc_markup"])
             return
 
         # Calculate page info
-        current_page = start_index // s.number_of_product + 1
-        total_pages = (total_purchase + s.number_of_product -
-                       1) // s.number_of_product
+        total_pages = max((total_purchase + s.number_of_product -
+                           1) // s.number_of_product, current_page)
 
         # Page number
         result_data = texts[usr_lng]["textProducts"].format(
@@ -834,25 +1548,8 @@ async def user_purchase_products(query: CallbackQuery) -> None:
             ) + SEP_LINE
 
         # Pagination buttons
-        products_keys = []
-
-        # Add "Previous" button only if there is a previous page
-        if start_index > 0:
-            products_keys.append(
-                InlineKeyboardButton(
-                    texts[usr_lng]["textPrev"],
-                    callback_data=f"{purchase_products_cb}_{start_index - s.number_of_product}"
-                )
-            )
-
-        # Add "Next" button only if there is a next page
-        if start_index + s.number_of_product < total_purchase:
-            products_keys.append(
-                InlineKeyboardButton(
-                    texts[usr_lng]["textNext"],
-                    callback_data=f"{purchase_products_cb}_{start_index + s.number_of_product}"
-                )
-            )
+        products_keys = history_page_buttons(purchase_products_cb, current_page, user_products, "purchase_date",
+                                             has_older, has_newer, usr_lng)
 
         # Add buttons for account and main menu navigation
         navigation_buttons = [
@@ -869,6 +1566,7 @@ async def user_purchase_products(query: CallbackQuery) -> None:
         else:
             products_markup = InlineKeyboardMarkup(navigation_buttons)
 
+        history_pages[page_key] = (result_data, products_markup)
         await send_message(query=query,
                            txt=result_data,
                            reply_markup=products_markup,
@@ -881,61 +1579,96 @@ async def user_purchase_products(query: CallbackQuery) -> None:
 # Create a user account if it doesn't exist
 async def check_create_account(update: Update) -> None:
     user_id = update.effective_user.id
-    usr_lng = await user_language(user_id)
-    found: bool = await sync_to_async(UserData.objects.filter(id=user_id).exists, thread_sensitive=True)()
+    if profiles.is_known(user_id):
+        return  # returning user, no query
 
-    if not found:
-        try:
-            first_name = update.effective_user.first_name or None
-            last_name = update.effective_user.last_name or None
-            username = update.effective_user.username or None
-
-            new_user = UserData(
-                id=user_id,
-                first_name=first_name,
-                last_name=last_name,
-                username=username,
-            )
-            await sync_to_async(new_user.save, thread_sensitive=True)()
-        except Exception as e:
-            await send_message(update=update,
-                               txt=texts[usr_lng]["textError"])
-            logger.error(f"Error in check_create_account function: {e}")
+    try:
+        # idempotent upsert, a double tap can't create the account twice
+        await sync_to_async(profiles.ensure_account, thread_sensitive=True)(
+            user_id,
+            update.effective_user.first_name or None,
+            update.effective_user.last_name or None,
+            update.effective_user.username or None,
+        )
+    except Exception as e:
+        usr_lng = await user_language(user_id)
+        await send_message(update=update,
+                           txt=texts[usr_lng]["textError"])
+        logger.error(f"Error in check_create_account function: {e}")
 
 
 async def change_user_language(query: CallbackQuery):
-    user = await sync_to_async(UserData.objects.filter(id=query.from_user.id).first, thread_sensitive=True)()
+    user_id = query.from_user.id
+    current = (await user_profile(user_id)).language
 
     try:
-        next_lang_idx = (lang_keys.index(user.language) + 1) % len(lang_keys)
-        user.language = lang_keys[next_lang_idx]
+        next_lang_idx = (lang_keys.index(current) + 1) % len(lang_keys)
+        language = lang_keys[next_lang_idx]
     except:
         logger.error("Can't find next language in change_user_language function.")
-        user.language = LANG1
+        language = LANG1
 
-    await sync_to_async(user.save, thread_sensitive=True)()
-    language_cache[user.id] = user.language
+    # one UPDATE, written through to the cached profile
+    await sync_to_async(profiles.set_language, thread_sensitive=True)(user_id, language)
 
     await send_message(query=query,
-                       txt=texts[user.language]["textMenu"],
-                       reply_markup=buttons[user.language]['main_menu_markup'])
+                       txt=texts[language]["textMenu"],
+                       reply_markup=buttons[language]['main_menu_markup'])
+
+
+# Shared TimezoneFinder: polygon data is loaded once (lazily, or at startup with TIMEZONE_FINDER_EAGER)
+# and lookups run in an executor, off the event loop
+timezone_finder: timezonefinder.TimezoneFinder | None = None
+timezone_finder_lock = threading.Lock()
+timezone_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="timezone")
+TIMEZONE_BUCKET_DIGITS = 2  # coordinates rounded to 0.01 degree (~1 km) share a lookup
+timezone_buckets: LRUCache = LRUCache(maxsize=50_000)  # (lat, lng) bucket -> timezone name or None
+timezone_offsets: TTLCache = TTLCache(maxsize=1024, ttl=3600)  # timezone name -> utc offset, follows DST within an hour
+
+
+def get_timezone_finder() -> timezonefinder.TimezoneFinder:
+    global timezone_finder
+    if timezone_finder is None:
+        with timezone_finder_lock:
+            if timezone_finder is None:
+                timezone_finder = timezonefinder.TimezoneFinder()
+    return timezone_finder
+
+
+async def timezone_at(lat: float, lng: float) -> str | None:
+    """Timezone name at a location, cached per coordinate bucket."""
+    bucket = (round(lat, TIMEZONE_BUCKET_DIGITS), round(lng, TIMEZONE_BUCKET_DIGITS))
+    if bucket in timezone_buckets:
+        return timezone_buckets[bucket]
+
+    timezone_str = await asyncio.get_running_loop().run_in_executor(
+        timezone_executor, lambda: get_timezone_finder().timezone_at(lng=lng, lat=lat))
+    timezone_buckets[bucket] = timezone_str
+    return timezone_str
+
+
+def timezone_offset_of(timezone_str: str) -> float:
+    """Current UTC offset of a timezone in hours (as a float)."""
+    offset = timezone_offsets.get(timezone_str)
+    if offset is None:
+        offset = timezone_offsets[timezone_str] = \
+            pytz_timezone(timezone_str).utcoffset(datetime.now()).total_seconds() / 3600
+    return offset
 
 
 async def get_user_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
     usr_id = update.effective_user.id
     usr_lng = await user_language(usr_id)
     user_location = update.message.location
-    tf = timezonefinder.TimezoneFinder()
-    timezone_str = tf.timezone_at(
-        lng=user_location.longitude, lat=user_location.latitude)
+    try:
+        timezone_str = await timezone_at(user_location.latitude, user_location.longitude)
+    except Exception as e:
+        logger.error(f"Error in timezone lookup: {e}")
+        timezone_str = None
 
     if timezone_str:
-        user_time_zone = pytz_timezone(timezone_str)
-        # now_in_user_timezone = datetime.now(user_timezone)
-
-        # Calculate timezone difference in hours (as a float) using .utcoffset()
-        timezone_offset = user_time_zone.utcoffset(
-            datetime.now()).total_seconds() / 3600
+        # Calculate timezone difference in hours (as a float)
+        timezone_offset = timezone_offset_of(timezone_str)
 
         await send_message(update=update,
                            txt=f"{texts[usr_lng]['textTimezoneSuccess']}\n{timezone_str}")
@@ -944,12 +1677,10 @@ async def get_user_location(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # await send_message(update=update,
         #                    txt=f"UTC Offset: {timezone_offset:.2f} hours")
 
-        # Update user timezone and offset
-        user = await sync_to_async(UserData.objects.filter(id=usr_id).first, thread_sensitive=True)()
-        # Assuming `utc_offset` is a FloatField in your model
-        user.utc_offset = timezone_offset
-        await sync_to_async(user.save, thread_sensitive=True)()
-        timezone_cache[usr_id] = timezone_offset
+        # Update user offset, written through to the cached profile
+        await sync_to_async(profiles.set_utc_offset, thread_sensitive=True)(usr_id, timezone_offset)
+        history_pages.invalidate(transactions_cb, usr_id)
+        history_pages.invalidate(purchase_products_cb, usr_id)
 
     else:
         await send_message(update=update,
@@ -984,44 +1715,98 @@ async def get_description(user_lang: str, current_object: Product) -> str:
         return current_object.description or None
 
 
+async def get_catalog_snapshot() -> catalog.CatalogSnapshot:
+    """Catalog snapshot kept fresh by catalog_refresh_job, browsing costs no queries."""
+    snapshot = catalog.current()
+    if snapshot is None:
+        snapshot = await sync_to_async(catalog.get_snapshot, thread_sensitive=True)()
+    return snapshot
+
+
+# Compiled catalog keyboards: ((snapshot version, category_in_row, product_in_row), {(language, category id): markup}).
+# Replaced as a whole when the key changes, so a markup is never built against a mixed state.
+catalog_keyboards: tuple = (None, {})
+
+
+def compile_catalog_keyboard(snapshot: catalog.CatalogSnapshot, s: BotSettings, usr_lng: str,
+                             cat_id: int | None) -> InlineKeyboardMarkup | None:
+    """Category menu (cat_id None) or product menu of one category, None when there is nothing to show."""
+    if cat_id is None:
+        items, per_row, callback = snapshot.categories, s.category_in_row, select_category_cb
+    else:
+        category = snapshot.by_id.get(cat_id)
+        if category is None:
+            return None
+        items, per_row, callback = category.products, s.product_in_row, select_product_cb
+    if not items:
+        return None
+
+    keys = [
+        [InlineKeyboardButton(item.names[usr_lng], callback_data=f"{callback}_{item.id}")
+         for item in items[i:i + per_row]]
+        for i in range(0, len(items), per_row)
+    ]
+    keys.append([InlineKeyboardButton(texts[usr_lng]["buttonBackMainMenu"], callback_data=main_menu_cb)])
+    if cat_id is not None:
+        keys.append([InlineKeyboardButton(texts[usr_lng]["textBackButton"], callback_data=categories_cb)])
+    return InlineKeyboardMarkup(keys)
+
+
+def catalog_keyboard(snapshot: catalog.CatalogSnapshot, s: BotSettings, usr_lng: str,
+                     cat_id: int | None = None) -> InlineKeyboardMarkup | None:
+    """Compiled keyboard for (language, category), built once per snapshot version and layout."""
+    global catalog_keyboards
+    key = (snapshot.version, s.category_in_row, s.product_in_row)
+    current_key, markups = catalog_keyboards
+    if current_key != key:
+        markups = {}
+        catalog_keyboards = (key, markups)
+
+    try:
+        return markups[(usr_lng, cat_id)]
+    except KeyError:
+        markup = markups[(usr_lng, cat_id)] = compile_catalog_keyboard(snapshot, s, usr_lng, cat_id)
+        return markup
+
+
+async def catalog_refresh_job():
+    """Rebuild dirty categories right away and everything every CATALOG_MAX_STALENESS."""
+    while True:
+        try:
+            if catalog.needs_rebuild():
+                await sync_to_async(catalog.get_snapshot, thread_sensitive=True)()
+        except Exception as e:
+            logger.error(f"Error in catalog_refresh_job: {e}")
+        await asyncio.sleep(1)
+
+
+async def stock_drift_job():
+    """Optional periodic comparison of Product.available_count with the real count."""
+    while True:
+        await asyncio.sleep(STOCK_DRIFT_CHECK_INTERVAL)
+        try:
+            drift = await sync_to_async(find_stock_drift, thread_sensitive=True)()
+            for product_id, stored, real in drift:
+                logger.warning(f"Stock drift on product {product_id}: stored {stored}, real {real} "
+                               f"(run manage.py rebuild_stock_counts)")
+        except Exception as e:
+            logger.error(f"Error in stock_drift_job: {e}")
+
+
 async def product_categories(query: CallbackQuery):
     usr_lng = await user_language(query.from_user.id)
 
-  # Only categories that have at least one product with available ProductDetail
-    categories_qs = Category.objects.annotate(
-        has_available_products=Exists(
-            ProductDetail.objects.filter(
-                product__category=OuterRef('pk'),
-                is_purchased=False,
-                is_delete=False,
-                product__is_delete=False
-            )
-        )
-    ).filter(has_available_products=True)
+    # Only categories that have at least one product with available ProductDetail
+    snapshot = await get_catalog_snapshot()
 
-    categories = await sync_to_async(list, thread_sensitive=True)(categories_qs)
-
-    if not categories:
+    if not snapshot.categories:
         await send_message(query=query,
                     txt=texts[usr_lng]["textNotFound"],
                         reply_markup=buttons[usr_lng]["back_menu_markup"])
         return
     try:
         s: BotSettings = await get_settings()
-        # Create buttons for categories
-        temp_keys = []
-        for i in range(0, len(categories), s.category_in_row):
-            row = await asyncio.gather(
-                *[get_name(usr_lng, cat) for cat in categories[i:i + s.category_in_row]]
-            )
-            temp_keys.append(
-                [InlineKeyboardButton(name, callback_data=f"{select_category_cb}_{cat.id}") for name, cat in
-                 zip(row, categories[i:i + s.category_in_row])]
-            )
-
-        temp_keys.append(
-            [InlineKeyboardButton(texts[usr_lng]["buttonBackMainMenu"], callback_data=main_menu_cb)])  # Add back button
-        temp_reply_markup = InlineKeyboardMarkup(temp_keys)
+        temp_reply_markup = catalog_keyboard(snapshot, s, usr_lng)
 
         await send_message(query=query,
                     txt=texts[usr_lng]["textProductCategories"],
@@ -1029,34 +1814,16 @@ async def product_categories(query: CallbackQuery):
     except Exception as e:
         logger.error(f"Error in product_categories function: {e}")
 
-@sync_to_async
-def get_available_products(category_id):
-    return list(
-        Product.objects.annotate(
-            has_available=Exists(
-                ProductDetail.objects.filter(
-                    product=OuterRef("pk"),
-                    is_purchased=False,
-                    is_delete=False
-                )
-            )
-        ).filter(has_available=True, category_id=category_id, is_delete=False).order_by("order")
-    )
-
 
-async def products(update: Update, query: CallbackQuery):
+async def products(update: Update, query: CallbackQuery, cat_id: int):
     usr_lng = await user_language(query.from_user.id)
     # Detect if current message is an image
     is_photo = bool(query.message.photo)
-    try:
-        # Extract category ID from callback data
-        cat_id: int = int(query.data.split('_')[1])
-    except (IndexError, ValueError):
-        await query.answer(texts[usr_lng]["textInvalidCategory"], show_alert=True)
-        return
 
-    # Fetch available products asynchronously
-    all_products = await get_available_products(category_id=cat_id)
+    # Available products from the catalog snapshot
+    snapshot = await get_catalog_snapshot()
+    current_cat = snapshot.by_id.get(cat_id)
+    all_products = current_cat.products if current_cat else ()
 
     if not all_products:
         if not is_photo:
@@ -1071,33 +1838,12 @@ async def products(update: Update, query: CallbackQuery):
 
     try:
         s: BotSettings = await get_settings()
-        # Create buttons for products
-        temp_keys = []
-        for i in range(0, len(all_products), s.product_in_row):
-            # Gather the product names asynchronously
-            names = await asyncio.gather(
-                *[get_name(usr_lng, prod) for prod in all_products[i:i + s.product_in_row]]
-            )
-            # Create a row of InlineKeyboardButtons
-            row = [
-                InlineKeyboardButton(
-                    name, callback_data=f"{select_product_cb}_{prod.id}")
-                for name, prod in zip(names, all_products[i:i + s.product_in_row])
-            ]
-            temp_keys.append(row)
-
-        temp_keys.append(
-            [InlineKeyboardButton(texts[usr_lng]["buttonBackMainMenu"], callback_data=main_menu_cb)])  # Add back button
-        temp_keys.append([InlineKeyboardButton(
-            texts[usr_lng]["textBackButton"], callback_data=categories_cb)])
-        temp_reply_markup = InlineKeyboardMarkup(temp_keys)
+        temp_reply_markup = catalog_keyboard(snapshot, s, usr_lng, cat_id)
 
         # Get category name
-        current_cat: Category = await sync_to_async(Category.objects.filter(id=cat_id, is_delete=False).first,
-                                                    thread_sensitive=True)()
         cat_name = ""
-        if current_cat:
-            cat_name = await get_name(usr_lng, current_cat) + " "
+        if not current_cat.is_delete:
+            cat_name = current_cat.names[usr_lng] + " "
         if not is_photo:
             await send_message(query=query,
                     txt=texts[usr_lng]["textProductList"].format(cat_name),
@@ -1110,34 +1856,23 @@ async def products(update: Update, query: CallbackQuery):
         logger.error(f"Error in products function: {e}")
 
 
-async def product_payment_detail(query: CallbackQuery):
+async def product_payment_detail(query: CallbackQuery, prod_id: int):
     usr_lng = await user_language(query.from_user.id)
 
-    # Extract product ID from callback data
-    try:
-        prod_id: int = int(query.data.split('_')[1])
-    except (IndexError, ValueError):
-        await query.answer(texts[usr_lng]["textInvalidProduct"], show_alert=True)
-        return
-
-    # Fetch product asynchronously
-    product_detail = await sync_to_async(
-        ProductDetail.objects.filter(
-            product_id=prod_id, is_purchased=False
-        ).select_related('product__category').first,
+    # Fetch product with its stock counter asynchronously
+    product: Product = await sync_to_async(
+        Product.objects.filter(
+            id=prod_id, available_count__gt=0
+        ).select_related('category').first,
         thread_sensitive=True
     )()
 
-    if not product_detail:
+    if not product:
         await query.answer(texts[usr_lng]["textProductSoldOut"], show_alert=True)
         return
 
     try:
-        # Count available items
-        available_count = await sync_to_async(
-            ProductDetail.objects.filter(product_id=prod_id, is_purchased=False).count,
-            thread_sensitive=True
-        )()
+        available_count = product.available_count
 
         # Get bot settings
         s: BotSettings = await get_settings()
@@ -1146,32 +1881,32 @@ async def product_payment_detail(query: CallbackQuery):
         temp_keys = [
             [InlineKeyboardButton(
                 texts[usr_lng]["textPayButton"],
-                callback_data=f'{payment_cb}_{product_detail.product.price}_{product_detail.product.id}'
+                callback_data=f'{payment_cb}_{product.price}_{product.id}'
             )],
             [InlineKeyboardButton(
                 texts[usr_lng]["textBackButton"],
-                callback_data=f'{select_category_cb}_{product_detail.product.category.id}'
+                callback_data=f'{select_category_cb}_{product.category.id}'
             )],
         ]
         temp_reply_markup = InlineKeyboardMarkup(temp_keys)
 
         # Build product description
-        description = await get_description(usr_lng, product_detail.product) or ""
+        description = await get_description(usr_lng, product) or ""
         if description:
             description = SEP_LINE_HTML + description
 
         # Build message text
-        product_price = product_detail.product.price
+        product_price = product.price
         ton_needed = round((product_price / ton_price['price']) + 0.05, 2)
         message_text = texts[usr_lng]["textPurchaseBill"].format(
-            await get_name(usr_lng, product_detail.product),
-            product_detail.product.price,
+            await get_name(usr_lng, product),
+            product.price,
             f"{s.wallet_currency} (~{ton_needed} TON)",
             available_count
         ) + description
 
-        # Decide whether to send image or text
-        product_image = product_detail.product.image
+        # Decide whether to send image or text, the optimised rendition when it is ready
+        product_image = product.image_rendition or product.image
         if not product_image or s.disable_product_images:
             # Text-only message
             await send_message(query=query,
@@ -1184,12 +1919,8 @@ async def product_payment_detail(query: CallbackQuery):
                 full_url = product_image.url
                 if SITE_DOMAIN is not None:
                     full_url = f"{SITE_DOMAIN}{full_url}"
-                    
-                await query.message.reply_photo(
-                    photo=full_url,
-                    caption=message_text,
-                    reply_markup=temp_reply_markup
-                )
+
+                await send_product_photo(query, product, full_url, message_text, temp_reply_markup)
             except Exception as e:
                 # Fallback to text if image fails
                 # Text-only message
@@ -1203,15 +1934,39 @@ async def product_payment_detail(query: CallbackQuery):
         logger.error(f"Error in product_payment_detail function: {e}")
 
 
+async def send_product_photo(query: CallbackQuery, product: Product, full_url: str, caption: str, reply_markup):
+    """Send the product image by its cached Telegram file_id, uploading from full_url only the first time."""
+    if product.image_file_id:
+        try:
+            return await query.message.reply_photo(
+                photo=product.image_file_id, caption=caption, reply_markup=reply_markup)
+        except BadRequest as e:
+            # file_id no longer accepted, forget it and send from the url
+            logger.error(f"Cached file_id of product {product.id} rejected: {e}")
+            await sync_to_async(
+                Product.objects.filter(pk=product.pk, image_file_id=product.image_file_id).update,
+                thread_sensitive=True
+            )(image_file_id=None)
+
+    message = await query.message.reply_photo(photo=full_url, caption=caption, reply_markup=reply_markup)
+    if message.photo:
+        # only for the image it was sent from, an image changed meanwhile keeps its own key
+        await sync_to_async(
+            Product.objects.filter(pk=product.pk, image_key=product.image_key).update,
+            thread_sensitive=True
+        )(image_file_id=message.photo[-1].file_id)
+    return message
+
+
 async def update_product_detail(query: CallbackQuery, prod_id: int, usr_lng: str):
     try:
         # Detect if current message is an image
         is_photo = bool(query.message.photo)
         
         available_count = await sync_to_async(
-            ProductDetail.objects.filter(
-                product_id=prod_id, is_purchased=False).count
-        )()
+            Product.objects.filter(id=prod_id).values_list("available_count", flat=True).first,
+            thread_sensitive=True
+        )() or 0
 
         # Get the existing message text
         if not is_photo:
@@ -1242,45 +1997,28 @@ async def update_product_detail(query: CallbackQuery, prod_id: int, usr_lng: str
         logger.error(f"Error updating product detail message: {e}")
 
 
-async def payment(update: Update, context: CallbackContext, query: CallbackQuery):
+async def payment(update: Update, context: CallbackContext, query: CallbackQuery, payment_amount: int, prod_id: int):
     user_id = query.from_user.id
     usr_lng = await user_language(user_id)
 
-    try:
-        payment_amount: int = int(query.data.split('_')[1])
-        prod_id: int = int(query.data.split('_')[2])
-    except (IndexError, ValueError):
-        await query.answer(texts[usr_lng]["textInvalidPaymentAmount"], show_alert=True)
-        return
-
     # Run the atomic block in sync code via sync_to_async
     @sync_to_async
     def process_payment():
         with transaction.atomic():
-            # Lock user row
-            user = UserData.objects.select_for_update().filter(id=user_id).first()
-            if not user:
-                return "no_user", None, None
-
-            if user.balance < payment_amount:
-                return "not_enough", None, None
-
-            # Lock product row and fetch related Product
-            product_detail = ProductDetail.objects.select_for_update().select_related('product').filter(
-                product_id=prod_id, is_purchased=False
-            ).first()
+            # Debit in one conditional UPDATE, the only round trip to the user row on success
+            debited = UserData.objects.filter(id=user_id, balance__gte=payment_amount).update(
+                balance=F("balance") - payment_amount
+            )
+            if not debited:
+                exists = UserData.objects.filter(id=user_id).exists()
+                return ("not_enough" if exists else "no_user"), None, None
+
+            # Claim a detail no other buyer holds (and the stock counter), concurrent buyers get different rows
+            product_detail = claim_product_detail(prod_id, UserData(id=user_id))  # only the key is used
             if not product_detail:
+                transaction.set_rollback(True)  # undo the debit
                 return "sold_out", None, None
 
-            # Update balances and product
-            user.balance -= payment_amount
-            product_detail.is_purchased = True
-            product_detail.buyer = user
-            product_detail.purchase_date = timezone.now()
-            
-            product_detail.save()
-            user.save()
-            
             # Return the related product name
             return "success", product_detail.details, product_detail.product
     
@@ -1298,6 +2036,7 @@ async def payment(update: Update, context: CallbackContext, query: CallbackQuery
     elif status == "sold_out":
         await query.answer(text=texts[usr_lng]["textProductSoldOut"], show_alert=True)
     elif status == "success":
+        history_changed(purchase_products_cb, user_id)
         await send_message_with_retry(
             bot=context.bot,
             chat_id=query.message.chat.id,
@@ -1309,36 +2048,185 @@ async def payment(update: Update, context: CallbackContext, query: CallbackQuery
 # endregion
 
 
+# region Notifications
+
+class NotificationQueue:
+    """
+    Outbound user notifications, decoupled from deposit ingestion.
+
+    Ingestion only calls enqueue(). Worker tasks send under Telegram's limits
+    (~30 messages/s globally, ~1 message/s per chat), merge everything pending
+    for the same chat into one message and honour RetryAfter.
+    """
+
+    def __init__(self, workers: int = 4, global_rate: float = 25, per_chat_interval: float = 1.0):
+        self.workers = workers
+        self.per_chat_interval = per_chat_interval
+        self._limiter = RateLimiter(global_rate, burst=int(global_rate))
+        self._pending: dict = {}  # chat_id -> [(enqueued_at, text_key, args), ...]
+        self._next_send: TTLCache = TTLCache(maxsize=100_000, ttl=per_chat_interval * 2)
+        self._ready: asyncio.Queue | None = None
+        self._tasks: list = []
+        self.stats = {"enqueued": 0, "coalesced": 0, "sent": 0, "failed": 0,
+                      "latency_total": 0.0, "latency_max": 0.0}
+
+    @property
+    def depth(self) -> int:
+        return sum(len(items) for items in self._pending.values())
+
+    def start(self, bot) -> None:
+        self._ready = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._worker(bot)) for _ in range(self.workers)]
+
+    def enqueue(self, chat_id: int, text_key: str, *args) -> None:
+        self.stats["enqueued"] += 1
+        item = (asyncio.get_running_loop().time(), text_key, args)
+        if chat_id in self._pending:
+            self._pending[chat_id].append(item)
+            self.stats["coalesced"] += 1
+            return
+
+        self._pending[chat_id] = [item]
+        if self._ready is None:
+            logger.error("NotificationQueue.enqueue() called before start()")
+            return
+        self._ready.put_nowait(chat_id)
+
+    async def stop(self, timeout: float = 10) -> None:
+        """Wait for pending notifications to go out, then stop the workers."""
+        if self._ready is not None:
+            try:
+                await asyncio.wait_for(self._ready.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"NotificationQueue stopped with {self.depth} notifications pending")
+
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def log_stats(self) -> None:
+        sent = self.stats["sent"] or 1
+        logger.warning(
+            f"Notifications: {self.stats['enqueued']} enqueued, {self.stats['coalesced']} coalesced, "
+            f"{self.stats['sent']} sent, {self.stats['failed']} failed, depth {self.depth}, "
+            f"avg latency {self.stats['latency_total'] / sent:.2f} s, max {self.stats['latency_max']:.2f} s"
+        )
+
+    async def _worker(self, bot) -> None:
+        while True:
+            chat_id = await self._ready.get()
+            try:
+                await self._send(bot, chat_id)
+            except Exception as e:
+                logger.error(f"Error in NotificationQueue worker: {e}")
+            finally:
+                self._ready.task_done()
+
+    async def _send(self, bot, chat_id: int) -> None:
+        loop = asyncio.get_running_loop()
+
+        # per chat spacing, reserved before sleeping so other workers queue behind it
+        send_at = max(loop.time(), self._next_send.get(chat_id, 0))
+        self._next_send[chat_id] = send_at + self.per_chat_interval
+        if send_at > loop.time():
+            await asyncio.sleep(send_at - loop.time())
+
+        # pop late, so anything enqueued while waiting is merged into this message
+        items = self._pending.pop(chat_id, [])
+        if not items:
+            return
+
+        usr_lng = await user_language(chat_id)
+        text = "\n\n".join(texts[usr_lng][key].format(*args) for _, key, args in items)
+
+        for attempt in range(3):
+            await self._limiter.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text, parse_mode="Markdown")
+                latency = loop.time() - items[0][0]
+                self.stats["sent"] += 1
+                self.stats["latency_total"] += latency
+                self.stats["latency_max"] = max(self.stats["latency_max"], latency)
+                return
+            except RetryAfter as e:
+                retry_after = e.retry_after
+                if isinstance(retry_after, timedelta):
+                    retry_after = retry_after.total_seconds()
+                await asyncio.sleep(retry_after)
+            except Forbidden:
+                break  # user blocked the bot, retrying won't help
+            except Exception as e:
+                logger.warning(f"Failed to notify user {chat_id}: {e}")
+                await asyncio.sleep(2 ** attempt)
+
+        self.stats["failed"] += 1
+
+
+notifier: NotificationQueue = NotificationQueue()
+
+
+async def stats_log_job():
+    """
+    Runtime stats in the log while the bot runs, not only at shutdown: notification queue,
+    history page cache, callback routes and outbound HTTP.
+    """
+    while True:
+        await asyncio.sleep(STATS_LOG_INTERVAL)
+        try:
+            notifier.log_stats()
+            history_pages.log_stats()
+            callback_router.log_stats()
+            log_http_timings()
+        except Exception as e:
+            logger.error(f"Error in stats_log_job: {e}")
+
+# endregion
+
+
 # region Handlers
 
+# counts into routing.route_queries for the route being dispatched
+def count_route_query(execute, sql, params, many, context):
+    counter = route_queries.get()
+    if counter is not None:
+        counter[0] += 1
+    return execute(sql, params, many, context)
+
+
+def install_query_counter(sender, connection, **kwargs):
+    connection.execute_wrappers.append(count_route_query)
+
+
+connection_created.connect(install_query_counter)
+
+
+callback_router = CallbackRouter(lambda user_id: user_language(user_id), texts)
+# Adding a screen: one route declaration (callback prefix, name, handler, argument converters)
+callback_router.route(main_menu_cb, "main_menu", lambda update, context, query: start_menu(update, context, query))
+callback_router.route(balance_cb, "balance", lambda update, context, query: user_balance(update, context, query))
+callback_router.route(account_menu_cb, "account_menu", lambda update, context, query: account_menu_call_back(query))
+callback_router.route(account_info_cb, "account_info", lambda update, context, query: account_info(query, context))
+callback_router.route(deposit_cb, "deposit", lambda update, context, query: pay_link(update, context, query))
+callback_router.route(categories_cb, "categories", lambda update, context, query: product_categories(query))
+callback_router.route(change_lang_cb, "change_language", lambda update, context, query: change_user_language(query))
+# history screens read their keyset cursor from query.data (decode_page_cursor)
+callback_router.route(transactions_cb, "transactions", lambda update, context, query: account_transactions(query))
+callback_router.route(purchase_products_cb, "purchases", lambda update, context, query: user_purchase_products(query))
+callback_router.route(select_category_cb, "products",
+                      lambda update, context, query, cat_id: products(update, query, cat_id),
+                      int, invalid_text="textInvalidCategory")
+callback_router.route(select_product_cb, "product_detail",
+                      lambda update, context, query, prod_id: product_payment_detail(query, prod_id),
+                      int, invalid_text="textInvalidProduct")
+callback_router.route(payment_cb, "payment",
+                      lambda update, context, query, amount, prod_id: payment(update, context, query, amount, prod_id),
+                      int, int, invalid_text="textInvalidPaymentAmount")
+
+
 async def callback_query_handler(update: Update, context: CallbackContext) -> None:
     query: CallbackQuery = update.callback_query
-    query_data = query.data
-
-    if query_data == main_menu_cb:  # Main Menu
-        await start_menu(update, context, query)
-    elif query_data == balance_cb:  # User Balance
-        await user_balance(update, context, query)
-    elif query_data == account_menu_cb:  # Account Menu
-        await account_menu_call_back(query)
-    elif query_data == account_info_cb:  # User Account Info
-        await account_info(query)
-    elif query_data == deposit_cb:  # Deposit Link
-        await pay_link(update, context, query)
-    elif query_data == categories_cb:  # Product Categories
-        await product_categories(query)
-    elif query_data == change_lang_cb:  # Product Categories
-        await change_user_language(query)
-    elif query_data.startswith(transactions_cb):  # User Transaction
-        await account_transactions(query)
-    elif query_data.startswith(purchase_products_cb):  # User Purchase Products
-        await user_purchase_products(query)
-    elif query_data.startswith(f"{select_category_cb}_"):  # Selected category
-        await products(update, query)
-    elif query_data.startswith(f"{select_product_cb}_"):  # Selected product
-        await product_payment_detail(query)
-    elif query_data.startswith(f"{payment_cb}_"):  # Payment processing
-        await payment(update, context, query)
+    await callback_router.dispatch(update, context)
 
     await query.answer()  # Stop button animation
     return
@@ -1358,37 +2246,65 @@ async def error_handler(update: Update, context: CallbackContext):
 # endregion
 
 
-async def user_language(user_id: int):
+# UserData row read by load_user_profile on a profile cache miss, for the handlers of the same update.
+# PTB runs all handler groups of an update in one task; every update resets it.
+update_user_row: ContextVar = ContextVar("update_user_row", default=None)
+
+
+def current_user_row(user_id: int):
+    """Row of user_id read for the current update, None when it wasn't read (profile cache hit)."""
+    user = update_user_row.get()
+    return user if user is not None and user.id == user_id else None
+
+
+async def load_user_profile(update: Update, context: CallbackContext) -> None:
+    """
+    Group -1 handler: load the user's profile once per update, before any other handler.
+    Handlers read it with profiles.cached() (no query); nothing is stored per user in context.
+    """
+    update_user_row.set(None)
+    if not update.effective_user:
+        return
+    user_id = update.effective_user.id
     try:
-        if user_id in language_cache:
-            return language_cache[user_id]
+        if profiles.cached(user_id) is None:
+            _, user = await sync_to_async(profiles.load, thread_sensitive=True)(user_id)
+            update_user_row.set(user)
+
+        # changed Telegram names are written by names_flush_job, in batches
+        tg_user = update.effective_user
+        profiles.note_names(user_id, tg_user.first_name, tg_user.last_name, tg_user.username)
+    except Exception as e:
+        logger.error(f"Error in load_user_profile: {e}")
+
+
+async def names_flush_job():
+    while True:
+        await asyncio.sleep(NAMES_FLUSH_INTERVAL)
+        try:
+            await sync_to_async(profiles.flush_names, thread_sensitive=True)()
+        except Exception as e:
+            logger.error(f"Error in names_flush_job: {e}")
 
-        user = await sync_to_async(UserData.objects.filter(id=user_id).first, thread_sensitive=True)()
-        if not user:
-            language_cache[user_id] = LANG1
-            return LANG1
 
-        if user.language not in texts:
-            user.language = LANG1
-            await sync_to_async(user.save, thread_sensitive=True)()
+async def user_profile(user_id: int):
+    """Profile from the cache (filled by load_user_profile), one query when missing."""
+    profile = profiles.cached(user_id)
+    if profile is None:
+        profile, _ = await sync_to_async(profiles.load, thread_sensitive=True)(user_id)
+    return profile
 
-        language_cache[user_id] = user.language
-        return user.language
 
+async def user_language(user_id: int):
+    try:
+        return (await user_profile(user_id)).language
     except:
         return LANG1
 
 
 async def user_timezone(user_id: int):
     try:
-        if user_id not in timezone_cache:
-            user = await sync_to_async(UserData.objects.filter(id=user_id).first, thread_sensitive=True)()
-            if not user:
-                timezone_cache[user_id] = 0
-                return 0
-            timezone_cache[user_id] = user.utc_offset
-
-        return timezone_cache[user_id]
+        return (await user_profile(user_id)).utc_offset
     except:
         return 0
 
@@ -1423,17 +2339,82 @@ async def send_message(update: Update = None,
     
 
 # Todo: Move them to Django(celery)
+background_tasks: list = []
+# deposit addresses with a polling task, fixed at startup so pay links and the user -> address
+# mapping never change under a running bot; edits of the address list apply on restart
+polled_addresses: list = []
+
+
 async def start_background_tasks(application):
     print("Bot start successfully")
+    get_http_session()
+    try:
+        await warm_seen_hashes()
+        await load_price_history()
+        await sync_to_async(profiles.load_all, thread_sensitive=True)()
+        logger.warning(f"User profiles loaded: {profiles.stats()}")
+    except Exception as e:
+        logger.error(f"Failed to warm startup caches: {e}")
+    if TIMEZONE_FINDER_EAGER:
+        asyncio.get_running_loop().run_in_executor(timezone_executor, get_timezone_finder)
     # background task for getting TON price
-    asyncio.create_task(ton_price_job())
-    asyncio.create_task(ton_polling_job(application))
-    asyncio.create_task(failed_transactions_job(application))
-    
+    notifier.start(application.bot)
+    background_tasks.append(asyncio.create_task(ton_price_job()))
+    # one polling task per deposit address
+    s: BotSettings = await get_settings()
+    polled_addresses[:] = s.deposit_addresses()
+    for i, address in enumerate(polled_addresses):
+        background_tasks.append(asyncio.create_task(ton_polling_job(application, address, primary=i == 0)))
+    background_tasks.append(asyncio.create_task(failed_transactions_job(application)))
+    background_tasks.append(asyncio.create_task(catalog_refresh_job()))
+    background_tasks.append(asyncio.create_task(names_flush_job()))
+    if STOCK_DRIFT_CHECK_INTERVAL:
+        background_tasks.append(asyncio.create_task(stock_drift_job()))
+    if STATS_LOG_INTERVAL:
+        background_tasks.append(asyncio.create_task(stats_log_job()))
+
+
+async def stop_background_tasks(application):
+    # post_stop: polling has stopped but the bot is still initialized, so notifications can go out
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    background_tasks.clear()
+
+    # ingestion is stopped, let the queued notifications drain
+    await notifier.stop()
+    notifier.log_stats()
+    history_pages.log_stats()
+    callback_router.log_stats()
+
+    try:
+        await flush_price_snapshots()
+    except Exception as e:
+        logger.error(f"Failed to flush TON price snapshots: {e}")
+
+    try:
+        await sync_to_async(profiles.flush_names, thread_sensitive=True)()
+    except Exception as e:
+        logger.error(f"Failed to flush user name changes: {e}")
+
+
+async def close_resources(application):
+    # post_shutdown: the bot's HTTP client is closed by now
+    log_http_timings()
+    await close_http_session()
+    timezone_executor.shutdown(wait=False)
+
 
 # Main function
 def main() -> None:
-    app = Application.builder().token(TOKEN).post_init(start_background_tasks).build()
+    app = (
+        Application.builder()
+        .token(TOKEN)
+        .post_init(start_background_tasks)
+        .post_stop(stop_background_tasks)
+        .post_shutdown(close_resources)
+        .build()
+    )
 
     handlers = [
         # Check account or create only here
@@ -1442,11 +2423,12 @@ def main() -> None:
         CommandHandler("menu", start_menu),
         CommandHandler("balance", user_balance),
         CommandHandler("pay", pay_link),
-        # CommandHandler("set_timezone", timezone_hint),
-        # MessageHandler(filters.LOCATION, get_user_location),
+        CommandHandler("set_timezone", timezone_hint),
+        MessageHandler(filters.LOCATION, get_user_location),
         CallbackQueryHandler(callback_query_handler),
     ]
 
+    app.add_handler(TypeHandler(Update, load_user_profile), group=-1)
     app.add_handlers(handlers)
     app.add_error_handler(error_handler)
 
@@ -21,6 +21,12 @@ LANG1, LANG2 = "ru", "en"
 TOKEN = config("TOKEN", default="")
 UPDATE_SETTING_COMMAND = config("UPDATE_SETTING_COMMAND", default="update")
 SITE_DOMAIN = config("SITE_DOMAIN", default=None)
+# Seconds between Product.available_count drift checks, 0 disables
+STOCK_DRIFT_CHECK_INTERVAL = config("STOCK_DRIFT_CHECK_INTERVAL", default=0, cast=int)
+# Load timezone polygons at startup instead of on the first /set_timezone location
+TIMEZONE_FINDER_EAGER = config("TIMEZONE_FINDER_EAGER", default=False, cast=bool)
+# Seconds between runtime stats log lines (notification queue, history page cache, routes, HTTP), 0 disables
+STATS_LOG_INTERVAL = config("STATS_LOG_INTERVAL", default=300, cast=int)
 
 SEP_LINE = "\n`" + "_" * 30 + "`\n\n"
 SEP_LINE_HTML = "\n" + "_" * 40 + "\n\n"
@@ -4,8 +4,8 @@ from . import models
 
 @admin.register(models.Transaction)
 class TransactionAdmin(admin.ModelAdmin):
-    list_display = ("user", "amount", "paid_time", "is_delete", "atomic_failed")
-    list_filter = ("paid_time", "is_delete", "atomic_failed")
+    list_display = ("user", "amount", "paid_time", "is_delete", "atomic_failed", "retry_count", "dead_letter")
+    list_filter = ("paid_time", "is_delete", "atomic_failed", "dead_letter")
     readonly_fields = ("user",
                        "amount",
                        "comment",
@@ -14,10 +14,29 @@ class TransactionAdmin(admin.ModelAdmin):
                        "price_currency",
                        "paid_time",
                        "atomic_failed",
-                       "lt"
+                       "lt",
+                       "retry_count",
+                       "next_retry_at",
+                       "last_error",
+                       "dead_letter"
                        )
     search_fields = ("user__id", "user__username", "tx_id", "comment", "lt")
+    actions = ["requeue_failed"]
+
+    @admin.action(description="Requeue selected failed transactions")
+    def requeue_failed(self, request, queryset):
+        count = queryset.filter(atomic_failed=True).update(
+            retry_count=0, next_retry_at=None, last_error=None, dead_letter=False
+        )
+        self.message_user(request, f"{count} failed transactions requeued.")
 
 @admin.register(models.TonCursor)
 class TonCursorAdmin(admin.ModelAdmin):
    readonly_fields = ("key", "last_lt")
+
+
+@admin.register(models.TonPriceSnapshot)
+class TonPriceSnapshotAdmin(admin.ModelAdmin):
+    list_display = ("created_at", "price", "currency")
+    list_filter = ("currency", "created_at")
+    readonly_fields = ("created_at", "price", "currency")
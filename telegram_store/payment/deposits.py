@@ -0,0 +1,96 @@
+"""Crediting TON deposits: every toncenter page is applied in one atomic block."""
+import logging
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import F, Case, When, Value, DecimalField
+
+from users import profiles
+from users.models import UserData
+from .models import Transaction, TonCursor
+
+logger = logging.getLogger(__name__)
+
+
+def ton_cursor_key(address: str) -> str:
+    return f"deposit_cursor_{address}"
+
+
+def apply_deposit_batch(address: str, txs: list, price, wallet_currency: str, seen=()) -> list:
+    """
+    Credit a batch of deposits (slim records, oldest first) in a single atomic block:
+    one tx_id__in lookup, one id__in lookup, one F() balance update,
+    a bulk_create of the Transaction rows and one cursor advance.
+
+    Hashes in `seen` are known to be recorded already and are skipped without a lookup.
+    Deposits of unknown users are recorded as failed transactions (retried by the bot)
+    and the user is dropped from the profile store, so the account is created again.
+    Any error rolls the whole batch back (balances, rows and cursor together).
+    Returns (user_id, ton_amount) for every credited deposit.
+    """
+    deposits = []
+    for tx in txs:
+        if not tx["hash"] or not tx["comment"] or tx["hash"] in seen:
+            continue
+        try:
+            deposits.append((tx, int(tx["comment"], 16)))
+        except ValueError:
+            logger.warning(f"Invalid comment (not hex): {tx['comment']}")
+
+    credited = []
+    with transaction.atomic():
+        recorded = set(
+            Transaction.objects.filter(tx_id__in=[tx["hash"] for tx, _ in deposits])
+                               .values_list("tx_id", flat=True)
+        )
+        known_users = set(
+            UserData.objects.filter(id__in={user_id for _, user_id in deposits})
+                            .values_list("id", flat=True)
+        )
+
+        rows = []
+        totals = {}
+        for tx, user_id in deposits:
+            if tx["hash"] in recorded:
+                continue
+            recorded.add(tx["hash"])
+            ton_amount = tx["value"] / 1e9
+            known = user_id in known_users
+
+            rows.append(Transaction(
+                user_id=user_id if known else None,
+                amount=ton_amount,
+                comment=tx["comment"],
+                tx_id=tx["hash"],
+                lt=tx["lt"],
+                price_per_ton=Decimal(price),
+                price_currency=wallet_currency,
+                atomic_failed=not known
+            ))
+            if not known:
+                logger.warning(f"User not found for id {user_id}, deposit {tx['hash']} recorded as failed")
+                transaction.on_commit(lambda user_id=user_id: profiles.forget(user_id))
+                continue
+
+            # Calculate TON deposit
+            balance_update = (Decimal(ton_amount) * Decimal(price)).quantize(Decimal("0.01"))
+            totals[user_id] = totals.get(user_id, Decimal(0)) + balance_update
+            credited.append((user_id, ton_amount))
+
+        if totals:
+            balance_field = DecimalField(max_digits=18, decimal_places=2)
+            UserData.objects.filter(id__in=list(totals)).update(
+                balance=F("balance") + Case(
+                    *[When(id=user_id, then=Value(amount, output_field=balance_field))
+                      for user_id, amount in totals.items()],
+                    output_field=balance_field
+                )
+            )
+        if rows:
+            Transaction.objects.bulk_create(rows, batch_size=500)
+
+        if txs:
+            max_lt = max(tx["lt"] for tx in txs)
+            TonCursor.objects.filter(key=ton_cursor_key(address), last_lt__lt=max_lt).update(last_lt=max_lt)
+
+    return credited
@@ -1,4 +1,5 @@
 from django.db import models
+from django.db.models import Q
 from users.models import UserData
 
 
@@ -21,8 +22,22 @@ class Transaction(models.Model):
     is_delete = models.BooleanField(default=False)
     atomic_failed =models.BooleanField(default=False)
 
+    # retry state of atomic_failed transactions
+    retry_count = models.PositiveIntegerField(default=0, verbose_name="Retry Attempts")
+    next_retry_at = models.DateTimeField(null=True, blank=True, verbose_name="Next Retry")
+    last_error = models.CharField(max_length=256, null=True, blank=True, verbose_name="Last Error")
+    dead_letter = models.BooleanField(default=False, verbose_name="Dead Letter")
+
     class Meta:
         ordering = ['-paid_time']
+        indexes = [
+            # transaction history of a user, newest first
+            models.Index(fields=["user", "-paid_time", "-id"], condition=Q(is_delete=False, atomic_failed=False),
+                         name="tx_history_idx"),
+            # failed transactions waiting for a retry, only a handful of rows
+            models.Index(fields=["next_retry_at"], condition=Q(atomic_failed=True, dead_letter=False, is_delete=False),
+                         name="tx_retry_pending_idx"),
+        ]
         verbose_name = "Transaction"
         verbose_name_plural = "Transactions"
 
@@ -31,7 +46,7 @@ class Transaction(models.Model):
 
 
 class TonCursor(models.Model):
-    key = models.CharField(max_length=32, unique=True)
+    key = models.CharField(max_length=96, unique=True)  # deposit_cursor_<address>
     last_lt = models.BigIntegerField(default=0)
     
     def __str__(self):
@@ -41,3 +56,19 @@ class TonCursor(models.Model):
         verbose_name = "Ton Cursor"
         verbose_name_plural = "Ton Cursor"
 
+
+class TonPriceSnapshot(models.Model):
+    currency = models.CharField(max_length=8, verbose_name="Currency")
+    price = models.DecimalField(max_digits=18, decimal_places=3, verbose_name="TON Price")
+    created_at = models.DateTimeField(verbose_name="Time")
+
+    def __str__(self):
+        return f"{self.price} {self.currency}"
+
+    class Meta:
+        ordering = ['-created_at']
+        verbose_name = "TON Price Snapshot"
+        verbose_name_plural = "TON Price Snapshots"
+        indexes = [
+            models.Index(fields=["currency", "created_at"], name="price_at_idx"),
+        ]
@@ -1,3 +1,125 @@
+import time
+from decimal import Decimal
+from unittest import mock
+
+from django.db import IntegrityError
+from django.db.models import F, Q
 from django.test import TestCase
+from django.utils import timezone
+
+from bot_settings import LANG1
+from products.tests import QueryPlanTestCase
+from users import profiles
+from users.models import UserData
+from .deposits import apply_deposit_batch, ton_cursor_key
+from .models import Transaction, TonCursor
+
+
+class TransactionQueryPlanTests(QueryPlanTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserData.objects.create(id=1)
+        Transaction.objects.bulk_create(
+            Transaction(user=cls.user, amount=1, comment=str(cls.user.id), tx_id=f"hash{i}",
+                        atomic_failed=i % 20 == 0)
+            for i in range(200)
+        )
+
+    def test_history_uses_history_index(self):
+        # get_transactions
+        qs = Transaction.objects.filter(
+            user_id=self.user.id, is_delete=False, atomic_failed=False
+        ).order_by('-paid_time', '-id')
+        self.assertUsesIndex(qs, "tx_history_idx")
+
+    def test_retry_batch_uses_pending_index(self):
+        # fetch_failed_transactions
+        qs = Transaction.objects.filter(
+            Q(next_retry_at__isnull=True) | Q(next_retry_at__lte=timezone.now()),
+            atomic_failed=True,
+            dead_letter=False,
+            is_delete=False,
+        ).order_by(F("next_retry_at").asc(nulls_first=True))[:100]
+        self.assertUsesIndex(qs, "tx_retry_pending_idx")
+
+
+def deposit(lt, user_id, value=1_000_000_000, tx_hash=None):
+    return {"lt": lt, "hash": tx_hash or f"hash{lt}", "comment": format(user_id, "x"), "value": value}
+
+
+class ApplyDepositBatchTests(TestCase):
+    address = "EQaddress"
+
+    def setUp(self):
+        self.user = UserData.objects.create(id=0x1234)
+        self.other = UserData.objects.create(id=0x5678)
+        self.cursor = TonCursor.objects.create(key=ton_cursor_key(self.address), last_lt=10)
+
+    def apply(self, txs, price=2):
+        return apply_deposit_batch(self.address, txs, price, "usd")
+
+    def assertState(self, balance, rows, last_lt):
+        self.user.refresh_from_db()
+        self.cursor.refresh_from_db()
+        self.assertEqual(self.user.balance, Decimal(balance))
+        self.assertEqual(Transaction.objects.count(), rows)
+        self.assertEqual(self.cursor.last_lt, last_lt)
+
+    def test_sums_deposits_of_the_same_user(self):
+        credited = self.apply([deposit(11, self.user.id), deposit(12, self.other.id),
+                               deposit(13, self.user.id, value=500_000_000)])
+
+        self.assertEqual(credited, [(self.user.id, 1.0), (self.other.id, 1.0), (self.user.id, 0.5)])
+        self.other.refresh_from_db()
+        self.assertEqual(self.other.balance, Decimal("2.00"))
+        self.assertState("3.00", 3, 13)
+
+    def test_skips_duplicate_hashes(self):
+        Transaction.objects.create(user=self.user, amount=1, comment="x", tx_id="recorded")
+
+        credited = self.apply([deposit(11, self.user.id, tx_hash="recorded"),  # already in the DB
+                               deposit(12, self.user.id, tx_hash="twice"),
+                               deposit(13, self.user.id, tx_hash="twice"),  # twice in the page
+                               deposit(14, self.user.id, tx_hash="seen")])
+
+        self.assertEqual(credited, [(self.user.id, 1.0), (self.user.id, 1.0)])
+        self.assertState("4.00", 3, 14)
+
+        # hashes already known to the caller are not looked up or credited
+        self.assertEqual(apply_deposit_batch(self.address, [deposit(15, self.user.id)], 2, "usd",
+                                             seen={"hash15"}), [])
+        self.assertState("4.00", 3, 15)
+
+    def test_unknown_user_is_recorded_as_failed(self):
+        profiles._users.put(profiles.UserProfile(0x9999, LANG1, 0.0, True, 0))  # account deleted in the admin
+
+        with self.assertLogs("payment.deposits", "WARNING"), self.captureOnCommitCallbacks(execute=True):
+            credited = self.apply([deposit(11, 0x9999), deposit(12, self.user.id)])
+
+        self.assertEqual(credited, [(self.user.id, 1.0)])
+        failed = Transaction.objects.get(tx_id="hash11")
+        self.assertEqual((failed.user_id, failed.atomic_failed, failed.comment), (None, True, "9999"))
+        self.assertFalse(profiles.is_known(0x9999))  # check_create_account() creates it again
+        self.assertState("2.00", 2, 12)
+
+    def test_failure_rolls_back_the_whole_batch(self):
+        with mock.patch.object(Transaction.objects, "bulk_create", side_effect=IntegrityError("boom")):
+            with self.assertRaises(IntegrityError):
+                self.apply([deposit(11, self.user.id), deposit(12, self.user.id)])
+
+        self.assertState("0.00", 0, 10)
+
+    def test_throughput_per_page(self):
+        users = UserData.objects.bulk_create(UserData(id=100 + i) for i in range(50))
+        pages, page_size = 20, 100
+
+        started = time.perf_counter()
+        for page in range(pages):
+            lt = 11 + page * page_size
+            self.apply([deposit(lt + i, users[i % len(users)].id) for i in range(page_size)])
+        elapsed = time.perf_counter() - started
 
-# Create your tests here.
+        self.assertEqual(Transaction.objects.count(), pages * page_size)
+        print(f"\napply_deposit_batch: {elapsed / pages * 1000:.1f} ms per {page_size} deposit page, "
+              f"{pages * page_size / elapsed:.0f} deposits/s")
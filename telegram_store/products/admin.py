@@ -1,8 +1,28 @@
+import io
+
+from django import forms
 from django.contrib import admin
+from django.http import StreamingHttpResponse
+from django.shortcuts import get_object_or_404, redirect
+from django.template.loader import render_to_string
+from django.template.response import TemplateResponse
+from django.urls import path
+from django.utils.html import format_html
+
 from . import models
+from .importer import iter_codes, iter_import
 from telegram_store.settings import MODELTRANSLATION_LANGUAGES as langs
 
 
+IMPORT_PROGRESS_MARKER = "<!-- import progress -->"
+
+
+class ImportCodesForm(forms.Form):
+    file = forms.FileField(help_text="UTF-8 .txt (one code per line) or .csv (codes in the first column)")
+    header = forms.BooleanField(required=False, initial=True, label="CSV has a header row",
+                                help_text="Skip the first row of a .csv file (column names, not a code)")
+
+
 class ProductDetailInline(admin.TabularInline):
     model = models.ProductDetail
     extra = 1  # number of empty forms to display
@@ -39,6 +59,58 @@ class ProductAdmin(admin.ModelAdmin):
         # ensure prefetch for category to optimize ordering
         return qs.select_related('category')
 
+    def get_urls(self):
+        return [
+            path("<int:object_id>/import-codes/",
+                 self.admin_site.admin_view(self.import_codes_view),
+                 name="products_product_import_codes"),
+        ] + super().get_urls()
+
+    def import_codes_view(self, request, object_id):
+        product = get_object_or_404(models.Product, pk=object_id)
+        if not self.has_change_permission(request, product):
+            return redirect("admin:products_product_changelist")
+
+        context = {
+            **self.admin_site.each_context(request),
+            "opts": self.model._meta,
+            "product": product,
+            "title": f"Import codes: {product}",
+        }
+        form = ImportCodesForm(request.POST or None, request.FILES or None)
+        if request.method == "POST" and form.is_valid():
+            upload = form.cleaned_data["file"]
+            is_csv = upload.name.lower().endswith(".csv")
+            page = render_to_string("admin/products/product/import_codes.html",
+                                    {**context, "importing": upload.name}, request)
+            head, _, tail = page.partition(IMPORT_PROGRESS_MARKER)
+            # the page is streamed, a progress line goes out after every committed chunk
+            header = is_csv and form.cleaned_data["header"]
+            return StreamingHttpResponse(self._stream_import(product, upload, is_csv, header, head, tail))
+
+        return TemplateResponse(request, "admin/products/product/import_codes.html", {**context, "form": form})
+
+    @staticmethod
+    def _stream_import(product, upload, is_csv: bool, header: bool, head: str, tail: str):
+        yield head
+        # large uploads are temporary files on disk, read them line by line
+        lines = io.TextIOWrapper(upload.file, encoding="utf-8-sig", newline="")
+        try:
+            result = None
+            for result in iter_import(product, iter_codes(lines, is_csv, header)):
+                yield format_html("<li>{} codes read, {} added</li>\n", result.read, result.added)
+        except UnicodeDecodeError:
+            yield format_html('<li class="errornote">{}</li>\n', "The file is not UTF-8 text, nothing was imported.")
+        else:
+            if result is None:
+                yield format_html("<li>{}</li>\n", "The file has no codes.")
+            else:
+                yield format_html("<li><strong>{} of {} codes imported ({} duplicates, {} invalid skipped).</strong></li>\n",
+                                  result.added, result.read, result.duplicates, result.invalid)
+        finally:
+            lines.detach()
+        yield tail
+
 
 @admin.register(models.ProductDetail)
 class ProductDetailAdmin(admin.ModelAdmin):
@@ -0,0 +1,186 @@
+"""
+In-process snapshot of the browsable catalog for the bot.
+
+Holds the categories that have something to sell, their available products in
+`order`, per-language names/descriptions and prices. Browsing reads the current
+snapshot without touching the database.
+
+Django signals on Category, Product and ProductDetail mark the affected
+categories dirty (after commit) and the next rebuild reloads only those.
+A full rebuild happens at least every CATALOG_MAX_STALENESS seconds, so changes
+made by another process (the admin site) show up within that window.
+"""
+import threading
+import time
+from typing import NamedTuple
+
+from django.db import transaction
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+
+from telegram_store.settings import MODELTRANSLATION_LANGUAGES
+from .models import Category, Product, ProductDetail
+
+CATALOG_MAX_STALENESS = 30  # seconds
+
+
+class CatalogProduct(NamedTuple):
+    id: int
+    category_id: int
+    names: dict  # language -> name
+    descriptions: dict  # language -> description
+    price: int
+    order: int
+
+
+class CatalogCategory(NamedTuple):
+    id: int
+    names: dict  # language -> name
+    is_delete: bool
+    products: tuple  # available CatalogProduct, sorted by order
+
+
+class CatalogSnapshot(NamedTuple):
+    version: int
+    built_at: float
+    categories: tuple  # CatalogCategory with at least one available product
+    by_id: dict  # category id -> CatalogCategory
+    product_category: dict  # product id -> category id
+
+
+_lock = threading.Lock()
+_snapshot: CatalogSnapshot | None = None
+_dirty: set = set()
+_dirty_all = False
+
+
+def _translations(obj, field: str) -> dict:
+    # same fallback as the bot used: empty translation -> main field
+    default = getattr(obj, field)
+    return {lang: getattr(obj, f"{field}_{lang}", None) or default for lang in MODELTRANSLATION_LANGUAGES}
+
+
+def _load_categories(category_ids=None) -> dict:
+    """Load categories (all, or only `category_ids`) with their available products."""
+    products_qs = Product.objects.filter(
+        available_count__gt=0, is_delete=False, category__isnull=False
+    ).order_by("order")
+    categories_qs = Category.objects.order_by("id")
+
+    if category_ids is not None:
+        products_qs = products_qs.filter(category_id__in=category_ids)
+        categories_qs = categories_qs.filter(id__in=category_ids)
+
+    products_by_category: dict = {}
+    for product in products_qs:
+        products_by_category.setdefault(product.category_id, []).append(CatalogProduct(
+            id=product.id,
+            category_id=product.category_id,
+            names=_translations(product, "name"),
+            descriptions=_translations(product, "description"),
+            price=product.price,
+            order=product.order,
+        ))
+
+    return {
+        category.id: CatalogCategory(
+            id=category.id,
+            names=_translations(category, "name"),
+            is_delete=category.is_delete,
+            products=tuple(products_by_category[category.id]),
+        )
+        for category in categories_qs if category.id in products_by_category
+    }
+
+
+def _build(by_id: dict, version: int) -> CatalogSnapshot:
+    by_id = dict(sorted(by_id.items()))
+    return CatalogSnapshot(
+        version=version,
+        built_at=time.monotonic(),
+        categories=tuple(by_id.values()),
+        by_id=by_id,
+        product_category={p.id: p.category_id for c in by_id.values() for p in c.products},
+    )
+
+
+def current() -> CatalogSnapshot | None:
+    """Current snapshot, never queries the database."""
+    return _snapshot
+
+
+def needs_rebuild() -> bool:
+    return (_snapshot is None or _dirty_all or bool(_dirty)
+            or time.monotonic() - _snapshot.built_at > CATALOG_MAX_STALENESS)
+
+
+def get_snapshot() -> CatalogSnapshot:
+    """Return a fresh snapshot, rebuilding (fully or only dirty categories) if needed."""
+    global _snapshot, _dirty_all
+
+    with _lock:
+        if not needs_rebuild():
+            return _snapshot
+
+        # take the dirty marks first, marks arriving during the load stay for next time
+        dirty, full = set(_dirty), _dirty_all
+        _dirty.clear()
+        _dirty_all = False
+
+        old = _snapshot
+        version = old.version + 1 if old else 1
+        if old is None or full or time.monotonic() - old.built_at > CATALOG_MAX_STALENESS:
+            by_id = _load_categories()
+            if old is not None and by_id == old.by_id:
+                # nothing changed, keep the version so keyboards compiled for it stay valid
+                _snapshot = old._replace(built_at=time.monotonic())
+            else:
+                _snapshot = _build(by_id, version)
+        else:
+            reloaded = _load_categories(dirty)
+            if all(old.by_id.get(cid) == reloaded.get(cid) for cid in dirty):
+                # e.g. a purchase that left the category's products as they were: keep the
+                # version so keyboards compiled for it stay valid
+                _snapshot = old
+            else:
+                by_id = {cid: cat for cid, cat in old.by_id.items() if cid not in dirty}
+                by_id.update(reloaded)
+                _snapshot = _build(by_id, version)._replace(built_at=old.built_at)
+
+        return _snapshot
+
+
+def mark_dirty(category_id: int | None = None) -> None:
+    """Mark one category (or everything, with None) for rebuild once the transaction commits."""
+    def _mark():
+        global _dirty_all
+        if category_id is None:
+            _dirty_all = True
+        else:
+            _dirty.add(category_id)
+
+    transaction.on_commit(_mark)
+
+
+def _product_category(product_id) -> int | None:
+    snapshot = _snapshot
+    return snapshot.product_category.get(product_id) if snapshot else None
+
+
+@receiver([post_save, post_delete], sender=Category)
+def _category_changed(sender, instance, **kwargs):
+    mark_dirty(instance.pk)
+
+
+@receiver([post_save, post_delete], sender=Product)
+def _product_changed(sender, instance, **kwargs):
+    previous = _product_category(instance.pk)
+    if previous is not None and previous != instance.category_id:
+        mark_dirty(previous)  # moved to another category
+    mark_dirty(instance.category_id)
+
+
+@receiver([post_save, post_delete], sender=ProductDetail)
+def _product_detail_changed(sender, instance, **kwargs):
+    # unknown product: it may have just become available, rebuild everything
+    mark_dirty(_product_category(instance.product_id))
@@ -0,0 +1,29 @@
+"""
+Image processing for renditions, free of Django imports so process pool workers
+can import it under any multiprocessing start method (spawn on Windows/macOS).
+"""
+import io
+
+from PIL import Image, ImageOps
+
+RENDITION_MAX_SIZE = 1280  # Telegram shows photos at most 1280px wide
+RENDITION_QUALITY = 85
+
+
+def render_telegram_jpeg(data: bytes) -> bytes:
+    """Original image bytes -> rendition bytes. Pure function, safe to run in a process pool."""
+    with Image.open(io.BytesIO(data)) as image:
+        image = ImageOps.exif_transpose(image)  # keep the orientation the EXIF data asked for
+        if image.mode in ("RGBA", "LA", "P"):
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        image.thumbnail((RENDITION_MAX_SIZE, RENDITION_MAX_SIZE), Image.LANCZOS)
+
+        out = io.BytesIO()
+        # no exif/icc arguments: metadata is dropped
+        image.save(out, "JPEG", quality=RENDITION_QUALITY, optimize=True, progressive=True)
+        return out.getvalue()
@@ -0,0 +1,81 @@
+"""
+Streaming bulk import of ProductDetail codes.
+
+Reads codes line by line (TXT: one code per line, CSV: first column, an optional
+header row is skipped), drops duplicates within each chunk and against the
+product's existing details, and inserts with bulk_create in chunks inside one
+transaction. Memory depends on the chunk size only, not on the file size.
+"""
+import csv
+from itertools import islice
+from typing import Callable, Iterable, Iterator, NamedTuple
+
+from django.db import transaction
+
+from . import catalog
+from .models import Product, ProductDetail, adjust_available_count
+
+IMPORT_CHUNK_SIZE = 1000
+DETAILS_MAX_LENGTH = ProductDetail._meta.get_field("details").max_length
+
+
+class ImportResult(NamedTuple):
+    read: int
+    added: int
+    duplicates: int
+    invalid: int  # empty after strip or longer than the details field
+
+
+def iter_codes(lines: Iterable[str], is_csv: bool = False, header: bool = False) -> Iterable[str]:
+    """Yield raw codes from text lines, lazily. header: the first row is column names, not a code."""
+    rows = csv.reader(lines) if is_csv else ([line] for line in lines)
+    if header:
+        next(rows, None)
+    for row in rows:
+        yield row[0] if row else ""
+
+
+def import_codes(product: Product, codes: Iterable[str], chunk_size: int = IMPORT_CHUNK_SIZE,
+                 progress: Callable[[ImportResult], None] | None = None) -> ImportResult:
+    """Insert new codes for product, all or nothing. progress is called after every chunk."""
+    result = ImportResult(0, 0, 0, 0)
+    for result in iter_import(product, codes, chunk_size):
+        if progress:
+            progress(result)
+    return result
+
+
+def iter_import(product: Product, codes: Iterable[str], chunk_size: int = IMPORT_CHUNK_SIZE) -> Iterator[ImportResult]:
+    """
+    import_codes() as a generator of the running totals, one per chunk. The import is
+    committed once the generator is exhausted; closing it early rolls everything back.
+    """
+    read = added = duplicates = invalid = 0
+    codes = iter(codes)
+
+    with transaction.atomic():
+        while chunk := list(islice(codes, chunk_size)):
+            read += len(chunk)
+            unique = {}
+            for code in chunk:
+                code = code.strip()
+                if not code or len(code) > DETAILS_MAX_LENGTH:
+                    invalid += 1
+                elif code in unique:
+                    duplicates += 1
+                else:
+                    unique[code] = None
+
+            # earlier chunks are already inserted, so this also catches duplicates across chunks
+            existing = set(ProductDetail.objects.filter(product=product, details__in=unique)
+                                                .values_list("details", flat=True))
+            duplicates += len(existing)
+            new = [ProductDetail(product=product, details=code) for code in unique if code not in existing]
+            ProductDetail.objects.bulk_create(new)
+            added += len(new)
+
+            yield ImportResult(read, added, duplicates, invalid)
+
+        # bulk_create skips save(), keep the stock counter and the catalog in step
+        adjust_available_count((product.id, True), added)
+        catalog.mark_dirty(product.category_id)
@@ -0,0 +1,50 @@
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from products.models import Product
+from products.imaging import render_telegram_jpeg
+from products.renditions import store_rendition
+
+
+class Command(BaseCommand):
+    help = "Build Telegram renditions of product images in a process pool (only missing ones unless --all)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--all", action="store_true", help="Rebuild renditions that already exist.")
+        parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+
+    def handle(self, *args, **options):
+        products = Product.objects.exclude(image="").exclude(image__isnull=True).order_by("id")
+        if not options["all"]:
+            products = products.filter(Q(image_rendition__isnull=True) | Q(image_rendition=""))
+        products = list(products)
+
+        built = failed = 0
+        workers = max(options["workers"], 1)
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            # a few images in flight per worker, originals are read here and only bytes cross processes
+            window = workers * 2
+            for start in range(0, len(products), window):
+                batch = products[start:start + window]
+                futures = []
+                for product in batch:
+                    try:
+                        with product.image.open("rb") as f:
+                            futures.append((product, pool.submit(render_telegram_jpeg, f.read())))
+                    except OSError as e:
+                        failed += 1
+                        self.stderr.write(f"Product {product.id}: {e}")
+
+                for product, future in futures:
+                    try:
+                        if store_rendition(product, future.result()):
+                            built += 1
+                    except Exception as e:
+                        failed += 1
+                        self.stderr.write(f"Product {product.id}: {e}")
+                self.stdout.write(f"{start + len(batch)}/{len(products)} processed")
+
+        self.stdout.write(self.style.SUCCESS(f"Built {built} renditions ({failed} failed)."))
@@ -0,0 +1,38 @@
+from argparse import BooleanOptionalAction
+
+from django.core.management.base import BaseCommand, CommandError
+
+from products.importer import IMPORT_CHUNK_SIZE, import_codes, iter_codes
+from products.models import Product
+
+
+class Command(BaseCommand):
+    help = "Import product codes (ProductDetail) from a TXT file (one per line) or the first column of a CSV file."
+
+    def add_arguments(self, parser):
+        parser.add_argument("product_id", type=int)
+        parser.add_argument("path")
+        parser.add_argument("--csv", action="store_true", help="Parse the file as CSV (default: by extension).")
+        parser.add_argument("--header", action=BooleanOptionalAction,
+                            help="Skip the first row as a header (default: yes for CSV, no for TXT).")
+        parser.add_argument("--chunk-size", type=int, default=IMPORT_CHUNK_SIZE)
+
+    def handle(self, *args, **options):
+        product = Product.objects.filter(pk=options["product_id"]).first()
+        if not product:
+            raise CommandError(f"Product {options['product_id']} not found.")
+
+        is_csv = options["csv"] or options["path"].lower().endswith(".csv")
+        header = is_csv if options["header"] is None else options["header"]
+
+        def progress(result):
+            self.stdout.write(f"read {result.read}, added {result.added}, "
+                              f"duplicates {result.duplicates}, invalid {result.invalid}")
+
+        with open(options["path"], encoding="utf-8-sig", newline="") as f:
+            result = import_codes(product, iter_codes(f, is_csv, header), options["chunk_size"], progress)
+
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {result.added} codes for {product} "
+            f"({result.duplicates} duplicates, {result.invalid} invalid skipped)."
+        ))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from products.stock import find_stock_drift, rebuild_available_counts
+
+
+class Command(BaseCommand):
+    help = "Rebuild Product.available_count from ProductDetail rows (use --check to only report drift)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--check", action="store_true", help="Only report products whose count drifted.")
+
+    def handle(self, *args, **options):
+        drift = find_stock_drift()
+        for product_id, stored, real in drift:
+            self.stdout.write(f"Product {product_id}: stored {stored}, real {real}")
+
+        if options["check"]:
+            self.stdout.write(f"{len(drift)} products drifted.")
+            return
+
+        updated = rebuild_available_counts()
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt available count of {updated} products ({len(drift)} drifted)."))
@@ -1,4 +1,10 @@
-from django.db import models
+import hashlib
+
+from django.db import models, transaction
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from users.models import UserData
 from telegram_store.settings import LANGUAGES
 
@@ -23,6 +29,14 @@ class Product(models.Model):
     description = models.TextField(verbose_name="Product Description", null=True, blank=True)
     is_delete = models.BooleanField(default=False, blank=True)
     order = models.IntegerField(default=0)
+    # Denormalized count of details not purchased and not deleted,
+    # maintained by ProductDetail.save() / delete (rebuild: manage.py rebuild_stock_counts)
+    available_count = models.PositiveIntegerField(default=0, editable=False, verbose_name="Available")
+    # Telegram file_id of the uploaded image, valid while image_key ("<path>:<content hash>") is unchanged
+    image_key = models.CharField(max_length=160, null=True, blank=True, editable=False)
+    image_file_id = models.CharField(max_length=256, null=True, blank=True, editable=False)
+    # optimised copy of image that the bot sends, built in the background (products.renditions)
+    image_rendition = models.ImageField(upload_to='products/renditions/', null=True, blank=True, editable=False)
 
     class Meta:
         verbose_name = "Product"
@@ -41,6 +55,45 @@ class Product(models.Model):
             return f"{self.name}({self.category.name})"
         return f"{self.name}"
 
+    def save(self, *args, **kwargs):
+        if not self._state.adding and not kwargs.get("force_insert") and kwargs.get("update_fields") is None:
+            # available_count is only changed by ProductDetail / stock.py updates, writing back the
+            # value loaded with this instance would undo purchases made since
+            kwargs["update_fields"] = [f.name for f in self._meta.concrete_fields
+                                       if not f.primary_key and f.name != "available_count"]
+        new_upload = bool(self.image) and not self.image._committed
+        super().save(*args, **kwargs)  # stores a new upload, image.name is final afterwards
+
+        # image replaced or removed: drop the cached Telegram file_id and the rendition, build a new one
+        current_path = self.image.name if self.image else None
+        stored_path = self.image_key.rpartition(":")[0] if self.image_key else None
+        if new_upload or current_path != stored_path:
+            key = f"{current_path}:{image_digest(self.image)}" if self.image else None
+            if key != self.image_key:
+                old_rendition = self.image_rendition.name if self.image_rendition else None
+                Product.objects.filter(pk=self.pk).update(image_key=key, image_file_id=None, image_rendition=None)
+                self.image_key, self.image_file_id, self.image_rendition = key, None, None
+                transaction.on_commit(lambda: self._image_changed(old_rendition))
+
+    def _image_changed(self, old_rendition: str | None) -> None:
+        from .renditions import schedule_rendition
+
+        if old_rendition:
+            self.image_rendition.storage.delete(old_rendition)
+        if self.image:
+            schedule_rendition(self.pk)
+
+
+def image_digest(image) -> str | None:
+    digest = hashlib.sha256()
+    try:
+        with image.open("rb") as f:
+            for chunk in f.chunks():
+                digest.update(chunk)
+    except OSError:  # file missing from storage
+        return None
+    return digest.hexdigest()[:32]
+
 
 class ProductDetail(models.Model):
     product = models.ForeignKey(to=Product, on_delete=models.SET_NULL, null=True, verbose_name="Product")
@@ -56,8 +109,65 @@ class ProductDetail(models.Model):
         ordering = ['-is_purchased']  # show not purchased first
         verbose_name = "Product Detail"
         verbose_name_plural = "Products Detail"
+        indexes = [
+            # stock: sellable details of a product (purchase, available_count recount)
+            models.Index(fields=["product"], condition=Q(is_purchased=False, is_delete=False),
+                         name="detail_stock_idx"),
+            # purchase history of a user, newest first
+            models.Index(fields=["buyer", "-purchase_date", "-id"], condition=Q(is_purchased=True, is_delete=False),
+                         name="detail_purchases_idx"),
+        ]
 
     def __str__(self):
         if self.product:
             return f"{self.product.name}"
         return "None"
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        if not instance.get_deferred_fields() & {"product_id", "is_purchased", "is_delete"}:
+            instance._stock_state = instance.stock_state()
+        return instance
+
+    def stock_state(self):
+        """(product id, whether this row counts towards Product.available_count)"""
+        return self.product_id, not self.is_purchased and not self.is_delete
+
+    def save(self, *args, **kwargs):
+        # Keep Product.available_count in step, inside the caller's transaction
+        with transaction.atomic():
+            is_new = self._state.adding
+            super().save(*args, **kwargs)
+
+            old = (None, False) if is_new else getattr(self, "_stock_state", None)
+            new = self.stock_state()
+            if old is None:
+                # state before the save is unknown (deferred fields), recount
+                update_available_count(self.product_id)
+            elif old != new:
+                adjust_available_count(old, -1)
+                adjust_available_count(new, +1)
+            self._stock_state = new
+
+
+def adjust_available_count(stock_state, delta: int) -> None:
+    product_id, counted = stock_state
+    if product_id is not None and counted:
+        Product.objects.filter(pk=product_id).update(
+            available_count=Greatest(F("available_count") + delta, 0)
+        )
+
+
+def update_available_count(product_id) -> None:
+    if product_id is not None:
+        Product.objects.filter(pk=product_id).update(
+            available_count=ProductDetail.objects.filter(
+                product_id=product_id, is_purchased=False, is_delete=False
+            ).count()
+        )
+
+
+@receiver(post_delete, sender=ProductDetail)
+def _product_detail_deleted(sender, instance, **kwargs):
+    adjust_available_count(instance.stock_state(), -1)
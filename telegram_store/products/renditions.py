@@ -0,0 +1,68 @@
+"""
+Telegram-optimised renditions of product images.
+
+The admin keeps whatever was uploaded in Product.image. A rendition is a
+progressive JPEG, at most RENDITION_MAX_SIZE (products.imaging) px on its longest side, without
+EXIF or other metadata; the bot sends it instead of the original.
+Renditions are built off the request in a small thread pool after the save
+commits, and by `manage.py build_renditions` for existing images.
+"""
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.core.files.base import ContentFile
+from django.db import close_old_connections
+
+from .imaging import render_telegram_jpeg
+from .models import Product
+
+logger = logging.getLogger(__name__)
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="renditions")
+
+
+def rendition_name(product: Product) -> str:
+    stem = os.path.splitext(os.path.basename(product.image.name))[0]
+    return f"{stem}.jpg"
+
+
+def store_rendition(product: Product, data: bytes) -> bool:
+    """Save rendition bytes for product if its image did not change meanwhile (image_key)."""
+    old_rendition = product.image_rendition.name if product.image_rendition else None
+    name = product.image_rendition.field.generate_filename(product, rendition_name(product))
+    name = product.image_rendition.storage.save(name, ContentFile(data))
+
+    # the cached file_id belongs to whatever was sent before, let the bot upload the rendition once
+    stored = Product.objects.filter(pk=product.pk, image_key=product.image_key).update(
+        image_rendition=name, image_file_id=None
+    )
+    if not stored:
+        product.image_rendition.storage.delete(name)
+        return False
+    if old_rendition and old_rendition != name:
+        product.image_rendition.storage.delete(old_rendition)
+    return True
+
+
+def build_rendition(product_id: int) -> bool:
+    product = Product.objects.filter(pk=product_id).first()
+    if not product or not product.image:
+        return False
+    with product.image.open("rb") as f:
+        data = f.read()
+    return store_rendition(product, render_telegram_jpeg(data))
+
+
+def _build_in_background(product_id: int) -> None:
+    close_old_connections()
+    try:
+        build_rendition(product_id)
+    except Exception as e:
+        logger.error(f"Error building rendition of product {product_id}: {e}")
+    finally:
+        close_old_connections()
+
+
+def schedule_rendition(product_id: int) -> None:
+    """Build the rendition of product_id in the background (call after the save committed)."""
+    _executor.submit(_build_in_background, product_id)
@@ -0,0 +1,82 @@
+"""Claiming sellable details, rebuild and drift check for the denormalized Product.available_count."""
+import random
+
+from django.db import connection
+from django.db.models import Count, F, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from . import catalog
+from .models import Product, ProductDetail, adjust_available_count
+
+CLAIM_CANDIDATES = 16  # rows a buyer picks from when there are no row locks
+CLAIM_ATTEMPTS = 5
+
+
+def claim_product_detail(product_id: int, buyer) -> ProductDetail | None:
+    """
+    Mark one sellable detail of product_id as bought by buyer and return it (None when sold out).
+    Must run inside transaction.atomic().
+
+    PostgreSQL: SELECT ... FOR UPDATE SKIP LOCKED, each concurrent buyer locks a different row
+    instead of queueing on the first one.
+    SQLite (no row locks): conditional UPDATE of a random candidate, retried when another buyer won it.
+    """
+    available = ProductDetail.objects.filter(product_id=product_id, is_purchased=False, is_delete=False)
+
+    if connection.features.has_select_for_update_skip_locked:
+        # of=("self",): don't lock the joined Product row, every buyer would wait on it
+        detail = available.select_for_update(skip_locked=True, of=("self",)) \
+                          .select_related("product").order_by("id").first()
+        if detail:
+            detail.is_purchased = True
+            detail.buyer = buyer
+            detail.purchase_date = timezone.now()
+            detail.save()  # adjusts available_count
+        return detail
+
+    for _ in range(CLAIM_ATTEMPTS):
+        candidates = list(available.order_by("id").values_list("id", flat=True)[:CLAIM_CANDIDATES])
+        if not candidates:
+            return None
+        random.shuffle(candidates)
+        for detail_id in candidates:
+            claimed = available.filter(id=detail_id).update(
+                is_purchased=True, buyer=buyer, purchase_date=timezone.now()
+            )
+            if claimed:
+                # .update() skips save() and its signals
+                adjust_available_count((product_id, True), -1)
+                detail = ProductDetail.objects.select_related("product").get(id=detail_id)
+                catalog.mark_dirty(detail.product.category_id)
+                return detail
+    return None
+
+
+def _real_count():
+    return Coalesce(
+        Subquery(
+            ProductDetail.objects.filter(product=OuterRef("pk"), is_purchased=False, is_delete=False)
+                                 .order_by()
+                                 .values("product")
+                                 .annotate(n=Count("id"))
+                                 .values("n"),
+            output_field=IntegerField()
+        ),
+        0
+    )
+
+
+def rebuild_available_counts() -> int:
+    """Recompute available_count for every product in one UPDATE, return rows updated."""
+    return Product.objects.update(available_count=_real_count())
+
+
+def find_stock_drift() -> list:
+    """Products whose stored available_count differs from the real count: [(id, stored, real)]"""
+    return [
+        (product_id, stored, real)
+        for product_id, stored, real in Product.objects.annotate(real_count=_real_count())
+                                                       .exclude(available_count=F("real_count"))
+                                                       .values_list("id", "available_count", "real_count")
+    ]
@@ -1,3 +1,197 @@
-from django.test import TestCase
+import random
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-# Create your tests here.
+from django.db import OperationalError, connection, connections, transaction
+from django.db.models import F
+from django.test import TestCase, TransactionTestCase
+from django.utils import timezone
+
+from users.models import UserData
+from . import catalog
+from .models import Category, Product, ProductDetail
+from .importer import import_codes, iter_codes
+from .stock import claim_product_detail
+
+
+class QueryPlanTestCase(TestCase):
+    """EXPLAIN helpers: a hot query must be answered through an index, not a full table scan."""
+
+    def assertUsesIndex(self, queryset, index_name=None):
+        with connection.cursor() as cursor:
+            if connection.vendor == "postgresql":
+                # tiny test tables are always cheaper to seq scan, ask whether an index plan exists at all
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            plan = queryset.explain()
+
+        table = queryset.model._meta.db_table
+        if connection.vendor == "sqlite":
+            full_scan = re.search(rf"\bSCAN (TABLE )?{table}\b(?! USING (COVERING )?INDEX)", plan)
+        else:
+            full_scan = re.search(rf"Seq Scan on {table}\b", plan)
+        self.assertIsNone(full_scan, f"full scan of {table}:\n{plan}")
+        if index_name:
+            self.assertIn(index_name, plan)
+
+
+class ProductQueryPlanTests(QueryPlanTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = UserData.objects.create(id=1)
+        category = Category.objects.create(name="Category")
+        cls.product = Product.objects.create(category=category, name="Product", price=10)
+        ProductDetail.objects.bulk_create(
+            ProductDetail(product=cls.product, details=f"detail {i}", is_purchased=i % 2 == 0,
+                          buyer=cls.user if i % 2 == 0 else None,
+                          purchase_date=timezone.now() if i % 2 == 0 else None)
+            for i in range(200)
+        )
+
+    def test_stock_lookup_uses_stock_index(self):
+        # process_payment / update_available_count
+        qs = ProductDetail.objects.filter(product_id=self.product.id, is_purchased=False, is_delete=False)
+        self.assertUsesIndex(qs, "detail_stock_idx")
+
+    def test_purchase_history_uses_purchases_index(self):
+        # get_user_purchases
+        qs = ProductDetail.objects.filter(
+            is_purchased=True, buyer__id=self.user.id, is_delete=False
+        ).order_by('-purchase_date', '-id')
+        self.assertUsesIndex(qs, "detail_purchases_idx")
+
+
+class ClaimProductDetailTests(TestCase):
+
+    def setUp(self):
+        self.user = UserData.objects.create(id=1)
+        self.product = Product.objects.create(name="Product", price=10)
+        for i in range(3):
+            ProductDetail.objects.create(product=self.product, details=f"detail {i}")
+
+    def test_claims_distinct_details_until_sold_out(self):
+        claimed = []
+        for _ in range(4):
+            with transaction.atomic():
+                claimed.append(claim_product_detail(self.product.id, self.user))
+
+        self.assertIsNone(claimed[-1])
+        self.assertEqual(len({detail.id for detail in claimed[:3]}), 3)
+        self.assertTrue(all(detail.is_purchased and detail.buyer_id == self.user.id for detail in claimed[:3]))
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_count, 0)
+
+
+class ConcurrentClaimTests(TransactionTestCase):
+    """N concurrent buyers (threads, one connection each) must get N distinct details."""
+
+    buyers = 200
+    stock = 150
+
+    def setUp(self):
+        UserData.objects.bulk_create(UserData(id=i, balance=100) for i in range(1, self.buyers + 1))
+        self.product = Product.objects.create(name="Product", price=10)
+        for i in range(self.stock):
+            ProductDetail.objects.create(product=self.product, details=f"detail {i}")
+
+    def buy(self, user_id):
+        """
+        process_payment() of the bot, returns (claimed detail id or None, lock wait in seconds).
+        Lock wait: blocked on the user row lock (the debit), plus failed attempts and their backoff.
+        """
+        waited = 0.0
+        try:
+            for attempt in range(200):
+                started = time.perf_counter()
+                try:
+                    with transaction.atomic():
+                        UserData.objects.filter(id=user_id, balance__gte=self.product.price).update(
+                            balance=F("balance") - self.product.price
+                        )
+                        waited += time.perf_counter() - started
+                        detail = claim_product_detail(self.product.id, UserData(id=user_id))
+                        if detail is None:
+                            transaction.set_rollback(True)
+                            return None, waited
+                        return detail.id, waited
+                except OperationalError:
+                    # SQLite has no row locks, a writer that loses the table lock starts over
+                    time.sleep(random.uniform(0, 0.001 * min(attempt + 1, 20)))
+                    waited += time.perf_counter() - started
+            raise AssertionError(f"buyer {user_id} never got the database lock")
+        finally:
+            connections.close_all()
+
+    def test_concurrent_buyers_get_distinct_details(self):
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=16) as pool:
+            claimed, waits = zip(*pool.map(self.buy, range(1, self.buyers + 1)))
+        elapsed = time.perf_counter() - started
+
+        sold = [detail_id for detail_id in claimed if detail_id is not None]
+        self.assertEqual(len(sold), self.stock)
+        self.assertEqual(len(set(sold)), self.stock)
+        self.product.refresh_from_db()
+        self.assertEqual(self.product.available_count, 0)
+        self.assertEqual(ProductDetail.objects.filter(is_purchased=True).count(), self.stock)
+        self.assertEqual(UserData.objects.filter(balance=90).count(), self.stock)
+        print(f"\nclaim_product_detail: {self.buyers} concurrent buyers ({connection.vendor}), "
+              f"{len(sold) / elapsed:.0f} purchases/s, lock wait per buyer "
+              f"mean {sum(waits) / len(waits) * 1000:.1f} ms, max {max(waits) * 1000:.1f} ms")
+
+
+class AvailableCountTests(TestCase):
+
+    def test_saving_a_stale_product_keeps_the_counter(self):
+        product = Product.objects.create(name="Product", price=10)
+        stale = Product.objects.get(pk=product.pk)
+        ProductDetail.objects.create(product=product, details="detail")
+
+        stale.price = 20
+        stale.save()
+
+        product.refresh_from_db()
+        self.assertEqual((product.price, product.available_count), (20, 1))
+
+
+class CatalogSnapshotTests(TestCase):
+
+    def setUp(self):
+        catalog._snapshot = None
+        catalog._dirty.clear()
+        self.user = UserData.objects.create(id=1)
+        category = Category.objects.create(name="Category")
+        self.product = Product.objects.create(category=category, name="Product", price=10)
+        for i in range(2):
+            ProductDetail.objects.create(product=self.product, details=f"detail {i}")
+
+    def claim(self):
+        with self.captureOnCommitCallbacks(execute=True), transaction.atomic():
+            claim_product_detail(self.product.id, self.user)
+        return catalog.get_snapshot()
+
+    def test_purchase_keeps_the_version_until_the_category_changes(self):
+        version = catalog.get_snapshot().version
+
+        self.assertEqual(self.claim().version, version)  # still available: same entries
+        snapshot = self.claim()  # sold out: the category disappears
+        self.assertEqual(snapshot.version, version + 1)
+        self.assertEqual(snapshot.categories, ())
+
+
+class ImportCodesTests(TestCase):
+
+    def test_skips_duplicates_and_invalid_codes(self):
+        product = Product.objects.create(name="Product", price=10)
+        ProductDetail.objects.create(product=product, details="existing")
+
+        lines = ["code,comment\n", "existing,x\n", "a\n", "b\n", "a\n", "\n", "c" * 300 + "\n", "c\n"]
+        result = import_codes(product, iter_codes(lines, is_csv=True, header=True), chunk_size=3)
+
+        self.assertEqual(result.added, 3)
+        self.assertEqual((result.read, result.duplicates, result.invalid), (7, 2, 2))
+        self.assertFalse(ProductDetail.objects.filter(details="code").exists())  # the header row
+        self.assertEqual(ProductDetail.objects.filter(product=product).count(), 4)
+        product.refresh_from_db()
+        self.assertEqual(product.available_count, 4)
@@ -0,0 +1,96 @@
+"""Callback query routing: callback_data "<prefix>[_arg_arg...]" -> handler, with per-route stats."""
+import logging
+import time
+from contextvars import ContextVar
+from typing import Awaitable, Callable, NamedTuple
+
+logger = logging.getLogger(__name__)
+
+# DB queries of the route being dispatched; the bot counts into it on every connection
+route_queries: ContextVar = ContextVar("route_queries", default=None)
+
+
+class Route(NamedTuple):
+    name: str
+    handler: Callable  # async (update, context, query, *args)
+    args: tuple  # converters of the "_" separated callback arguments
+    invalid_text: str  # answered when the arguments don't parse
+
+
+class CallbackRouter:
+    """
+    callback_data "<prefix>[_arg_arg...]" -> route, resolved with one dict lookup on the prefix.
+    Arguments are converted before the handler runs. Every route records calls, errors,
+    latency and DB queries.
+
+    `user_language` (async user_id -> language) and `texts` are used to answer
+    callbacks whose arguments don't parse.
+    """
+
+    def __init__(self, user_language: Callable[[int], Awaitable[str]], texts: dict):
+        self.user_language = user_language
+        self.texts = texts
+        self.routes: dict = {}
+        self.stats: dict = {}
+
+    def route(self, prefix: str, name: str, handler: Callable, *args: Callable,
+              invalid_text: str = "textNotFound") -> None:
+        if "_" in prefix or prefix in self.routes:
+            raise ValueError(f"Invalid or duplicate callback prefix: {prefix}")
+        self.routes[prefix] = Route(name, handler, args, invalid_text)
+        self.stats[name] = {"calls": 0, "errors": 0, "queries": 0, "latency_total": 0.0, "latency_max": 0.0}
+
+    @staticmethod
+    def parse(route: Route, raw_args: str) -> tuple | None:
+        """Converted arguments, or None if there are too few or one doesn't convert. Extra parts are ignored."""
+        if not route.args:
+            return ()
+        parts = raw_args.split('_')
+        if len(parts) < len(route.args):
+            return None
+        try:
+            return tuple(convert(part) for convert, part in zip(route.args, parts))
+        except ValueError:
+            return None
+
+    async def dispatch(self, update, context) -> bool:
+        query = update.callback_query
+        prefix, _, raw_args = query.data.partition('_')
+        route = self.routes.get(prefix)
+        if route is None:
+            return False
+
+        args = self.parse(route, raw_args)
+        if args is None:
+            usr_lng = await self.user_language(query.from_user.id)
+            await query.answer(self.texts[usr_lng][route.invalid_text], show_alert=True)
+            return True
+
+        stats = self.stats[route.name]
+        queries = [0]
+        token = route_queries.set(queries)
+        started = time.perf_counter()
+        try:
+            await route.handler(update, context, query, *args)
+        except Exception:
+            stats["errors"] += 1
+            raise
+        finally:
+            route_queries.reset(token)
+            elapsed = time.perf_counter() - started
+            stats["calls"] += 1
+            stats["queries"] += queries[0]
+            stats["latency_total"] += elapsed
+            stats["latency_max"] = max(stats["latency_max"], elapsed)
+        return True
+
+    def log_stats(self) -> None:
+        for name, stats in self.stats.items():
+            if not stats["calls"]:
+                continue
+            calls = stats["calls"]
+            logger.warning(
+                f"Route {name}: {calls} calls, {stats['errors']} errors, "
+                f"avg {stats['latency_total'] / calls * 1000:.1f} ms, max {stats['latency_max'] * 1000:.1f} ms, "
+                f"{stats['queries'] / calls:.1f} queries/call"
+            )
@@ -65,7 +65,18 @@ class BotSettings(models.Model):
     )
     ton_network_delay = models.PositiveIntegerField(
         verbose_name="TON Network Delay (seconds)",
-        help_text="Interval between deposit address checks(Fetch transactions)"
+        help_text="Maximum interval between deposit address checks(Fetch transactions) while idle"
+    )
+    ton_network_min_delay = models.PositiveIntegerField(
+        verbose_name="TON Network Min Delay (seconds)",
+        default=1,
+        help_text="Minimum interval between deposit address checks while deposits are arriving "
+                  "or shortly after a pay link was generated"
+    )
+    ton_api_rate_limit = models.PositiveIntegerField(
+        verbose_name="TON API Rate Limit",
+        default=1,
+        help_text="Max toncenter requests per second (1 without api key, 10 with key)"
     )
     
     failed_transactions_delay = models.PositiveIntegerField(
@@ -74,7 +85,12 @@ class BotSettings(models.Model):
     )
 
     # TON credentials
-    ton_deposit_address = models.CharField(max_length=256, verbose_name="TON Deposit Address")
+    ton_deposit_address = models.TextField(
+        verbose_name="TON Deposit Address",
+        help_text="One address per line. Users are spread across addresses by their ID, "
+                  "keep the first address first (it continues the old deposit cursor). "
+                  "Changes apply when the bot restarts."
+    )
     ton_network_api_key = models.CharField(
         max_length=256,
         verbose_name="TON Network API Key",
@@ -106,6 +122,15 @@ class BotSettings(models.Model):
             raise ValueError("Only one BotSettings instance allowed.")
         return super().save(*args, **kwargs)
 
+    def deposit_addresses(self) -> list:
+        addresses = self.ton_deposit_address.replace(",", "\n").split()
+        return list(dict.fromkeys(addresses))  # drop duplicates, keep order
+
+    def deposit_address_for(self, user_id: int, addresses: list = None) -> str:
+        # Deterministic: the same user always gets the same address (of the same address list)
+        addresses = addresses or self.deposit_addresses()
+        return addresses[user_id % len(addresses)]
+
     def __str__(self):
         return "Bot Configuration"
 
@@ -0,0 +1,290 @@
+"""
+Per-user profile (language, UTC offset) shared by every handler of an update.
+
+Profiles of all existing users live in a compact array-backed store, filled at
+startup by one streaming query, so a lookup costs no query. A user missing from
+it is read with one query and added. Language and timezone changes go through
+set_language() and set_utc_offset(), which write the row and update the store
+in place.
+
+Accounts are created with an idempotent upsert; a user in the store is known to
+exist, so returning users cost no query. Code that finds the row of a known user
+gone calls forget(). Changed Telegram names are queued and
+written in batches by flush_names().
+"""
+import threading
+from array import array
+from bisect import bisect_left
+from typing import NamedTuple
+
+from cachetools import TTLCache
+
+from bot_settings import LANG1, texts
+from .models import UserData
+
+NAMES_FLUSH_BATCH = 500
+NAME_FIELDS = ("first_name", "last_name", "username")
+LANGUAGES = list(texts.keys())
+
+
+class UserProfile(NamedTuple):
+    id: int
+    language: str
+    utc_offset: float
+    exists: bool  # False: no UserData row yet, defaults are used
+    names: int  # digest of (first_name, last_name, username) as stored, 0 when unknown
+
+
+def names_digest(first_name, last_name, username) -> int:
+    return (hash((first_name or None, last_name or None, username or None)) & 0xFFFFFFFF) or 1
+
+
+class UserAttributeStore:
+    """
+    user id -> (language index, UTC offset in quarter-hours, 32-bit names digest).
+
+    Parallel arrays sorted by id: array('q') ids, array('B') language, array('b') offset,
+    array('I') names, 14 bytes per user (about 14 MB per million), binary search lookups.
+    Users added after the bulk load sit in a small dict that is merged into the arrays
+    when it grows; changes to existing users are written in place.
+    """
+
+    MERGE_AT = 4096
+
+    def __init__(self):
+        self._ids = array("q")
+        self._languages = array("B")
+        self._offsets = array("b")
+        self._names = array("I")
+        self._recent: dict = {}  # user id -> (language index, quarter-hours, names digest)
+
+    @staticmethod
+    def pack(language: str, utc_offset: float, names: int) -> tuple:
+        language_index = LANGUAGES.index(language) if language in LANGUAGES else 0
+        return language_index, max(-128, min(127, round(utc_offset * 4))), names
+
+    def load(self, rows) -> None:
+        """Replace the contents with rows: (id, language, utc_offset, names digest) sorted by id."""
+        ids, languages, offsets, names = array("q"), array("B"), array("b"), array("I")
+        for user_id, language, utc_offset, digest in rows:
+            packed = self.pack(language, utc_offset, digest)
+            ids.append(user_id)
+            languages.append(packed[0])
+            offsets.append(packed[1])
+            names.append(packed[2])
+        self._ids, self._languages, self._offsets, self._names = ids, languages, offsets, names
+        self._recent = {}
+
+    def _index(self, user_id: int) -> int | None:
+        i = bisect_left(self._ids, user_id)
+        return i if i < len(self._ids) and self._ids[i] == user_id else None
+
+    def get(self, user_id: int) -> UserProfile | None:
+        i = self._index(user_id)
+        if i is not None:
+            packed = self._languages[i], self._offsets[i], self._names[i]
+        else:
+            packed = self._recent.get(user_id)
+            if packed is None:
+                return None
+        return UserProfile(user_id, LANGUAGES[packed[0]], packed[1] / 4, True, packed[2])
+
+    def __contains__(self, user_id: int) -> bool:
+        return self._index(user_id) is not None or user_id in self._recent
+
+    def put(self, profile: UserProfile) -> None:
+        self.put_packed(profile.id, self.pack(profile.language, profile.utc_offset, profile.names))
+
+    def put_packed(self, user_id: int, packed: tuple) -> None:
+        i = self._index(user_id)
+        if i is not None:
+            self._languages[i], self._offsets[i], self._names[i] = packed
+            return
+        self._recent[user_id] = packed
+        if len(self._recent) >= self.MERGE_AT:
+            self._merge()
+
+    def discard(self, user_id: int) -> None:
+        if self._recent.pop(user_id, None) is not None:
+            return
+        i = self._index(user_id)
+        if i is not None:
+            for a in (self._ids, self._languages, self._offsets, self._names):
+                del a[i]
+
+    def recent_items(self):
+        return self._recent.items()
+
+    def _merge(self) -> None:
+        """Merge the recent users into the arrays, copying runs of the old arrays between them."""
+        old = (self._ids, self._languages, self._offsets, self._names)
+        new = tuple(array(a.typecode) for a in old)
+        start = 0
+        for user_id, packed in sorted(self._recent.items()):
+            end = bisect_left(self._ids, user_id, start)
+            for target, source, value in zip(new, old, (user_id, *packed)):
+                target.extend(source[start:end])
+                target.append(value)
+            start = end
+        for target, source in zip(new, old):
+            target.extend(source[start:])
+        self._ids, self._languages, self._offsets, self._names = new
+        self._recent = {}
+
+    def __len__(self) -> int:
+        return len(self._ids) + len(self._recent)
+
+    def nbytes(self) -> int:
+        arrays = (self._ids, self._languages, self._offsets, self._names)
+        return sum(a.itemsize * len(a) for a in arrays)
+
+
+_lock = threading.Lock()
+_users = UserAttributeStore()
+_missing: TTLCache = TTLCache(maxsize=10_000, ttl=60)  # ids without an account, not worth a query per update
+_pending_names: dict = {}  # user id -> (first_name, last_name, username) waiting for flush_names()
+
+
+def cached(user_id: int) -> UserProfile | None:
+    """Profile from memory, never queries the database."""
+    with _lock:
+        profile = _users.get(user_id)
+        if profile is None and user_id in _missing:
+            profile = UserProfile(user_id, LANG1, 0.0, False, 0)
+        return profile
+
+
+def _from_row(user: UserData) -> UserProfile:
+    return UserProfile(user.id, user.language, user.utc_offset, True,
+                       names_digest(user.first_name, user.last_name, user.username))
+
+
+def load(user_id: int) -> tuple[UserProfile, UserData | None]:
+    """
+    Profile of user_id, from memory or from a single query.
+    The UserData row is returned too when it was read (fresh for this update), otherwise None.
+    """
+    profile = cached(user_id)
+    if profile is not None:
+        return profile, None
+
+    user = UserData.objects.filter(id=user_id).first()
+    if user is None:
+        with _lock:
+            _missing[user_id] = True
+        return UserProfile(user_id, LANG1, 0.0, False, 0), None
+
+    if user.language not in texts:
+        user.language = LANG1
+        user.save(update_fields=["language"])
+    profile = _from_row(user)
+    with _lock:
+        _users.put(profile)
+    return profile, user
+
+
+def load_all() -> int:
+    """Fill the store with every user, one streaming query, run at startup."""
+    global _users
+    rows = (
+        (user_id, language, utc_offset, names_digest(first_name, last_name, username))
+        for user_id, language, utc_offset, first_name, last_name, username in
+        UserData.objects.order_by("id")
+                        .values_list("id", "language", "utc_offset", *NAME_FIELDS)
+                        .iterator(chunk_size=10_000)
+    )
+    store = UserAttributeStore()
+    store.load(rows)
+    with _lock:
+        # users added or changed while the query streamed are newer than what it read
+        for user_id, packed in _users.recent_items():
+            store.put_packed(user_id, packed)
+        _users = store
+        return len(_users)
+
+
+def stats() -> dict:
+    with _lock:
+        return {"users": len(_users), "bytes": _users.nbytes(), "missing": len(_missing)}
+
+
+def is_known(user_id: int) -> bool:
+    with _lock:
+        return user_id in _users
+
+
+def forget(user_id: int) -> None:
+    """
+    Drop a user whose account turned out to be gone (deleted in the admin), so the next
+    update of that user reads the database and check_create_account() creates it again.
+    """
+    with _lock:
+        _users.discard(user_id)
+        _pending_names.pop(user_id, None)
+
+
+def ensure_account(user_id: int, first_name: str | None, last_name: str | None, username: str | None) -> None:
+    """
+    Create the account if needed: no query for a known id, otherwise one idempotent
+    INSERT ... ON CONFLICT DO NOTHING, safe against double taps and other processes.
+    """
+    if is_known(user_id):
+        return
+
+    UserData.objects.bulk_create(
+        [UserData(id=user_id, first_name=first_name, last_name=last_name, username=username)],
+        ignore_conflicts=True,
+    )
+    with _lock:
+        # the row may have existed already (unknown to this process), the next load reads the real one
+        _missing.pop(user_id, None)
+
+
+def note_names(user_id: int, first_name: str | None, last_name: str | None, username: str | None) -> bool:
+    """Queue a names refresh when Telegram reports different names than the stored ones."""
+    digest = names_digest(first_name, last_name, username)
+    with _lock:
+        profile = _users.get(user_id)
+        if profile is None or profile.names == digest:
+            return False
+        _pending_names[user_id] = (first_name or None, last_name or None, username or None)
+        _users.put(profile._replace(names=digest))
+    return True
+
+
+def flush_names() -> int:
+    """Write queued name changes with bulk_update, return the number of users updated."""
+    with _lock:
+        pending = dict(_pending_names)
+        _pending_names.clear()
+    if not pending:
+        return 0
+
+    rows = [UserData(id=user_id, **dict(zip(NAME_FIELDS, names))) for user_id, names in pending.items()]
+    try:
+        UserData.objects.bulk_update(rows, NAME_FIELDS, batch_size=NAMES_FLUSH_BATCH)
+    except Exception:
+        with _lock:
+            for user_id, names in pending.items():
+                _pending_names.setdefault(user_id, names)  # newer changes win
+        raise
+    return len(rows)
+
+
+def set_language(user_id: int, language: str) -> UserProfile | None:
+    UserData.objects.filter(id=user_id).update(language=language)
+    return _update(user_id, language=language)
+
+
+def set_utc_offset(user_id: int, utc_offset: float) -> UserProfile | None:
+    UserData.objects.filter(id=user_id).update(utc_offset=utc_offset)
+    return _update(user_id, utc_offset=utc_offset)
+
+
+def _update(user_id: int, **changes) -> UserProfile | None:
+    with _lock:
+        profile = _users.get(user_id)
+        if profile is not None:
+            profile = profile._replace(**changes)
+            _users.put(profile)
+        return profile
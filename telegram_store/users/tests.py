@@ -1,3 +1,397 @@
-from django.test import TestCase
+import random
+import time
+import tracemalloc
+from types import SimpleNamespace
+from unittest import mock
+from unittest.mock import AsyncMock
 
-# Create your tests here.
+import timezonefinder
+from asgiref.sync import async_to_sync
+from cachetools import TTLCache
+from django.db import connection
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import CaptureQueriesContext
+
+import bot
+from bot_settings import LANG1, LANG2, texts
+from products.models import Product, ProductDetail
+from routing import CallbackRouter, Route
+from . import profiles
+from .models import BotSettings, UserData
+
+
+class UserProfileTests(TestCase):
+
+    def setUp(self):
+        profiles._users = profiles.UserAttributeStore()
+        profiles._missing.clear()
+        profiles._pending_names.clear()
+        UserData.objects.create(id=1, language=LANG2, utc_offset=3.5, first_name="First")
+
+    def test_one_query_on_miss_none_on_hit(self):
+        with self.assertNumQueries(1):
+            profile, user = profiles.load(1)
+        self.assertEqual((profile.language, profile.utc_offset, profile.exists), (LANG2, 3.5, True))
+        self.assertEqual(user.id, 1)  # the row read for the profile is handed to the handler
+
+        with self.assertNumQueries(0):
+            profile, user = profiles.load(1)
+        self.assertIsNone(user)
+        self.assertEqual(profiles.cached(1), profile)
+
+    def test_unknown_user_then_create(self):
+        with self.assertNumQueries(1):
+            profile, _ = profiles.load(2)
+        self.assertFalse(profile.exists)
+
+        with self.assertNumQueries(1):
+            profiles.ensure_account(2, "First", None, "user")
+        profile, _ = profiles.load(2)
+        self.assertTrue(profile.exists)
+        self.assertTrue(UserData.objects.filter(id=2).exists())
+
+    def test_known_users_cost_no_query_and_upsert_is_idempotent(self):
+        profiles.load_all()
+        with self.assertNumQueries(0):
+            profiles.ensure_account(1, "First", None, None)
+
+        # a double tap racing past the known-id check
+        profiles.ensure_account(3, None, None, "user")
+        profiles._users = profiles.UserAttributeStore()
+        profiles.ensure_account(3, None, None, "user")
+        self.assertEqual(UserData.objects.filter(id=3).count(), 1)
+
+    def test_deleted_account_is_created_again_after_forget(self):
+        profiles.load_all()
+        UserData.objects.filter(id=1).delete()  # in the admin
+        profiles.ensure_account(1, "First", None, None)
+        self.assertFalse(UserData.objects.filter(id=1).exists())  # still known, no query
+
+        profiles.forget(1)
+        profiles.ensure_account(1, "First", None, None)
+        self.assertTrue(UserData.objects.filter(id=1).exists())
+
+    def test_changed_names_are_flushed_in_one_batch(self):
+        UserData.objects.create(id=2, username="old")
+        profiles.load(1)
+        profiles.load(2)
+
+        self.assertFalse(profiles.note_names(1, "First", None, None))  # unchanged
+        self.assertTrue(profiles.note_names(1, "Renamed", None, None))
+        self.assertTrue(profiles.note_names(2, None, None, "new"))
+        with self.assertNumQueries(1):
+            self.assertEqual(profiles.flush_names(), 2)
+
+        self.assertEqual(UserData.objects.get(id=1).first_name, "Renamed")
+        self.assertEqual(UserData.objects.get(id=2).username, "new")
+        self.assertFalse(profiles.note_names(2, None, None, "new"))
+
+    def test_changes_are_written_through(self):
+        profiles.load(1)
+        with self.assertNumQueries(1):
+            profiles.set_language(1, LANG1)
+        with self.assertNumQueries(1):
+            profiles.set_utc_offset(1, -2.0)
+
+        with self.assertNumQueries(0):
+            profile, _ = profiles.load(1)
+        self.assertEqual((profile.language, profile.utc_offset), (LANG1, -2.0))
+        self.assertEqual(UserData.objects.values_list("language", "utc_offset").get(id=1), (LANG1, -2.0))
+
+    def test_unknown_language_is_reset(self):
+        UserData.objects.filter(id=1).update(language="xx")
+        profile, _ = profiles.load(1)
+        self.assertEqual(profile.language, LANG1)
+        self.assertEqual(UserData.objects.get(id=1).language, LANG1)
+
+
+class UserAttributeStoreTests(TestCase):
+
+    def test_lookup_update_and_merge(self):
+        store = profiles.UserAttributeStore()
+        store.MERGE_AT = 3
+        store.load([(10, LANG2, 3.5, 7), (30, LANG1, -5.75, 8)])
+
+        store.put(profiles.UserProfile(20, LANG2, 5.25, True, 9))
+        store.put(profiles.UserProfile(40, LANG1, 0.0, True, 10))
+        store.put(profiles.UserProfile(10, LANG1, 1.0, True, 7))  # existing: in place
+        store.put(profiles.UserProfile(5, LANG1, 14.0, True, 11))  # third recent user: merged
+
+        self.assertEqual(list(store._ids), [5, 10, 20, 30, 40])
+        self.assertEqual(store.get(20), profiles.UserProfile(20, LANG2, 5.25, True, 9))
+        self.assertEqual(store.get(30).utc_offset, -5.75)
+        self.assertEqual(store.get(10).language, LANG1)
+        self.assertIsNone(store.get(15))
+        self.assertEqual(store.nbytes(), 5 * 14)
+
+        store.discard(20)
+        store.discard(15)  # unknown: nothing happens
+        self.assertEqual(list(store._ids), [5, 10, 30, 40])
+        self.assertEqual(store.get(30).utc_offset, -5.75)
+
+
+class HandlerQueryTests(TestCase):
+    """
+    Every handler makes at most one round trip to the user's UserData row, on top of the
+    profile load of the update (one query on a profile cache miss, none on a hit).
+    """
+
+    def setUp(self):
+        profiles._users = profiles.UserAttributeStore()
+        profiles._missing.clear()
+        self.user = UserData.objects.create(id=7, balance=100, language=LANG1)
+        bot.settings_cache["settings"] = BotSettings(ton_deposit_address="EQdeposit", wallet_currency="usd",
+                                                     wallet_currency_sign="$", telegram_wallet_link="https://t.me/w")
+        bot.ton_price["price"] = 2.0
+
+    def tearDown(self):
+        bot.settings_cache.clear()
+        bot.ton_price.clear()
+
+    def tap(self, callback_data):
+        """Run one callback update through load_user_profile and the router, return (handler's user row queries, fakes)."""
+        tg_user = SimpleNamespace(id=self.user.id, first_name=None, last_name=None, username=None)
+        message = SimpleNamespace(photo=None, text="name\nprice\navailable", caption=None, reply_markup=None,
+                                  chat=SimpleNamespace(id=self.user.id))
+        query = SimpleNamespace(from_user=tg_user, data=callback_data, message=message,
+                                answer=AsyncMock(), edit_message_text=AsyncMock())
+        update = SimpleNamespace(effective_user=tg_user, callback_query=query,
+                                 effective_chat=SimpleNamespace(send_message=AsyncMock()))
+        context = SimpleNamespace(bot=SimpleNamespace(send_message=AsyncMock()))
+
+        with CaptureQueriesContext(connection) as profile_queries:
+            async_to_sync(bot.load_user_profile)(update, context)  # the ContextVar it sets carries over
+        self.assertLessEqual(len(profile_queries), 1)
+        with CaptureQueriesContext(connection) as queries:
+            async_to_sync(bot.callback_query_handler)(update, context)
+        user_queries = [q["sql"] for q in queries.captured_queries if '"users_userdata"' in q["sql"]]
+        return user_queries, query, context
+
+    def assertOneRoundTrip(self, callback_data, cached: bool):
+        if cached:
+            profiles.load_all()
+        user_queries, query, context = self.tap(callback_data)
+        self.assertLessEqual(len(user_queries), 1, "\n".join(user_queries))
+        return query, context, user_queries
+
+    def test_balance(self):
+        for cached in (False, True):
+            query, _, user_queries = self.assertOneRoundTrip(bot.balance_cb, cached)
+            self.assertIn("100", query.edit_message_text.await_args.args[0])
+            if not cached:
+                self.assertEqual(user_queries, [])  # reuses the row the profile load read
+
+    def test_account_info(self):
+        for cached in (False, True):
+            query, _, user_queries = self.assertOneRoundTrip(bot.account_info_cb, cached)
+            self.assertIn("100", query.edit_message_text.await_args.args[0])
+            if not cached:
+                self.assertEqual(user_queries, [])
+
+    def test_pay_link(self):
+        for cached in (False, True):
+            query, _, _ = self.assertOneRoundTrip(bot.deposit_cb, cached)
+            self.assertIn("EQdeposit", query.edit_message_text.await_args.args[0])
+
+    def test_payment(self):
+        product = Product.objects.create(name="Product", price=10)
+        for i in range(2):
+            ProductDetail.objects.create(product=product, details=f"code {i}")
+
+        for cached in (False, True):
+            _, context, _ = self.assertOneRoundTrip(f"{bot.payment_cb}_10_{product.id}", cached)
+            self.assertIn("code", context.bot.send_message.await_args.kwargs["text"])
+        self.user.refresh_from_db()
+        self.assertEqual(self.user.balance, 80)
+
+
+class UserAttributeStoreBenchmark(SimpleTestCase):
+    """Memory and lookup time of the profile store against the language/timezone TTLCaches it replaced."""
+
+    users = 100_000
+    lookups = 100_000
+
+    @staticmethod
+    def measure(build):
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            structure = build()
+            return structure, tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    @staticmethod
+    def time_lookups(lookup, ids) -> float:
+        started = time.perf_counter()
+        for user_id in ids:
+            lookup(user_id)
+        return (time.perf_counter() - started) / len(ids)
+
+    def test_memory_and_lookup_time(self):
+        ids = random.Random(1).sample(range(10**6, 10**10), self.users)
+        sample = random.Random(2).choices(ids, k=self.lookups)
+
+        def build_store():
+            store = profiles.UserAttributeStore()
+            store.load((user_id, LANG1, 3.5, 12345) for user_id in sorted(ids))
+            return store
+
+        def build_ttl_caches():
+            language_cache = TTLCache(maxsize=self.users, ttl=600)
+            timezone_cache = TTLCache(maxsize=self.users, ttl=600)
+            for user_id in ids:
+                language_cache[user_id] = LANG1
+                timezone_cache[user_id] = 3.5
+            return language_cache, timezone_cache
+
+        store, store_bytes = self.measure(build_store)
+        (language_cache, timezone_cache), ttl_bytes = self.measure(build_ttl_caches)
+
+        store_lookup = self.time_lookups(store.get, sample)
+        ttl_lookup = self.time_lookups(lambda user_id: (language_cache[user_id], timezone_cache[user_id]), sample)
+
+        self.assertEqual(len(store), self.users)
+        self.assertEqual(store.get(sample[0]).utc_offset, 3.5)
+        self.assertLess(store_bytes, ttl_bytes)
+        print(f"\nUserAttributeStore: {store_bytes / self.users:.1f} bytes/user, {store_lookup * 1e6:.2f} us/lookup; "
+              f"TTLCache pair: {ttl_bytes / self.users:.1f} bytes/user, {ttl_lookup * 1e6:.2f} us/lookup "
+              f"({self.users} users)")
+
+
+class TimezoneLookupBenchmark(SimpleTestCase):
+    """Per-lookup latency of /set_timezone locations: new finder per lookup (before), shared finder, bucket hit."""
+
+    points = [(55.7512, 37.6184), (40.7128, -74.0060), (35.6895, 139.6917), (-33.8688, 151.2093), (51.5074, -0.1278)]
+
+    def setUp(self):
+        bot.timezone_buckets.clear()
+
+    def test_lookup_latency(self):
+        started = time.perf_counter()
+        for lat, lng in self.points[:2]:
+            before = timezonefinder.TimezoneFinder().timezone_at(lng=lng, lat=lat)
+        fresh = (time.perf_counter() - started) / 2
+
+        finder = bot.get_timezone_finder()
+        started = time.perf_counter()
+        for _ in range(200):
+            for lat, lng in self.points:
+                finder.timezone_at(lng=lng, lat=lat)
+        shared = (time.perf_counter() - started) / (200 * len(self.points))
+
+        async def bucket_hits(n):
+            await bot.timezone_at(*self.points[0])
+            started = time.perf_counter()
+            for _ in range(n):
+                await bot.timezone_at(*self.points[0])
+            return (time.perf_counter() - started) / n
+
+        hit = async_to_sync(bucket_hits)(10_000)
+
+        self.assertEqual(before, finder.timezone_at(lng=self.points[1][1], lat=self.points[1][0]))
+        print(f"\ntimezone lookup: new TimezoneFinder {fresh * 1000:.1f} ms, shared finder {shared * 1e6:.1f} us, "
+              f"bucket hit {hit * 1e6:.2f} us")
+
+    def test_same_bucket_resolves_with_one_finder_call(self):
+        finder = mock.Mock(wraps=bot.get_timezone_finder())
+
+        async def lookup_both():
+            # both round to (55.75, 37.62)
+            return await bot.timezone_at(55.7512, 37.6184), await bot.timezone_at(55.7538, 37.6211)
+
+        with mock.patch.object(bot, "get_timezone_finder", return_value=finder):
+            first, second = async_to_sync(lookup_both)()
+
+        self.assertEqual((first, second), ("Europe/Moscow", "Europe/Moscow"))
+        self.assertEqual(finder.timezone_at.call_count, 1)
+
+
+class CallbackRouterTests(SimpleTestCase):
+    """Argument parsing and prefix rules of the router, and dispatch overhead against the old elif chain."""
+
+    def setUp(self):
+        self.router = CallbackRouter(AsyncMock(return_value=LANG2), texts)
+
+    @staticmethod
+    def query(data):
+        return SimpleNamespace(data=data, from_user=SimpleNamespace(id=1), answer=AsyncMock())
+
+    def test_parse(self):
+        payment = Route("payment", None, (int, int), "textInvalidPaymentAmount")
+        self.assertEqual(CallbackRouter.parse(payment, "10_7"), (10, 7))
+        self.assertEqual(CallbackRouter.parse(payment, "10_7_extra"), (10, 7))  # extra parts are ignored
+        self.assertIsNone(CallbackRouter.parse(payment, "10"))
+        self.assertIsNone(CallbackRouter.parse(payment, ""))
+        self.assertIsNone(CallbackRouter.parse(payment, "10_x"))
+        self.assertIsNone(CallbackRouter.parse(payment, "1.5_7"))
+        self.assertEqual(CallbackRouter.parse(Route("balance", None, (), "textNotFound"), "anything"), ())
+
+    def test_prefix_rules(self):
+        self.router.route("bal", "balance", AsyncMock())
+        with self.assertRaises(ValueError):
+            self.router.route("bal_x", "balance_x", AsyncMock())  # "_" separates the arguments
+        with self.assertRaises(ValueError):
+            self.router.route("bal", "balance_again", AsyncMock())
+
+    def test_dispatch(self):
+        handler = AsyncMock()
+        self.router.route("pay", "payment", handler, int, int, invalid_text="textInvalidPaymentAmount")
+
+        query = self.query("pay_10_7")
+        update = SimpleNamespace(callback_query=query)
+        self.assertTrue(async_to_sync(self.router.dispatch)(update, None))
+        handler.assert_awaited_once_with(update, None, query, 10, 7)
+        self.assertEqual(self.router.stats["payment"]["calls"], 1)
+
+        query = self.query("pay_10")
+        self.assertTrue(async_to_sync(self.router.dispatch)(SimpleNamespace(callback_query=query), None))
+        query.answer.assert_awaited_once_with(texts[LANG2]["textInvalidPaymentAmount"], show_alert=True)
+        self.assertEqual(handler.await_count, 1)
+
+        self.assertFalse(async_to_sync(self.router.dispatch)(SimpleNamespace(callback_query=self.query("nope")), None))
+
+    def test_dispatch_overhead(self):
+        calls = []
+
+        async def handler(update, context, query, *args):
+            calls.append(args)
+
+        exact = [bot.main_menu_cb, bot.balance_cb, bot.account_menu_cb, bot.account_info_cb,
+                 bot.deposit_cb, bot.categories_cb, bot.change_lang_cb]
+        for prefix in exact + [bot.transactions_cb, bot.purchase_products_cb]:
+            self.router.route(prefix, prefix, handler)
+        self.router.route(bot.select_category_cb, "products", handler, int)
+        self.router.route(bot.select_product_cb, "product_detail", handler, int)
+        self.router.route(bot.payment_cb, "payment", handler, int, int)
+
+        async def elif_chain(update, context):
+            # before: compare query.data against every screen, each handler splits its own arguments
+            data = update.callback_query.data
+            if data in exact:
+                await handler(update, context, update.callback_query)
+            elif data.startswith(bot.transactions_cb) or data.startswith(bot.purchase_products_cb):
+                await handler(update, context, update.callback_query)
+            elif data.startswith(f"{bot.select_category_cb}_") or data.startswith(f"{bot.select_product_cb}_"):
+                await handler(update, context, update.callback_query, int(data.split('_')[1]))
+            elif data.startswith(f"{bot.payment_cb}_"):
+                parts = data.split('_')
+                await handler(update, context, update.callback_query, int(parts[1]), int(parts[2]))
+
+        data = exact + [bot.transactions_cb, f"{bot.select_category_cb}_3", f"{bot.select_product_cb}_12",
+                        f"{bot.payment_cb}_10_12"]
+        updates = [SimpleNamespace(callback_query=self.query(d)) for d in data] * 2000
+
+        async def run(dispatch):
+            started = time.perf_counter()
+            for update in updates:
+                await dispatch(update, None)
+            return (time.perf_counter() - started) / len(updates)
+
+        chain = async_to_sync(run)(elif_chain)
+        chain_calls, calls[:] = list(calls), []
+        routed = async_to_sync(run)(self.router.dispatch)
+
+        self.assertEqual(calls, chain_calls)
+        print(f"\ncallback dispatch: elif chain {chain * 1e6:.2f} us, CallbackRouter {routed * 1e6:.2f} us "
+              f"(incl. stats) per update")